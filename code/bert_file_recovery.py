@@ -4,20 +4,64 @@ Uses pretrained BERT models for text file corruption and recovery
 '''
 
 import os
+import re
 import random
 import torch
 from transformers import BertTokenizer, BertForMaskedLM, AutoTokenizer, AutoModelForMaskedLM
 from pathlib import Path
 from hashlib import sha256
 import time
+import heapq
+from inference_backends import TorchBackend, create_backend
+
+# Number of sentences run through BERT in one forward pass
+DEFAULT_BATCH_SIZE = 16
+# Longest input BERT accepts, in tokens. Longer inputs are run as windows
+# starting every WINDOW_STRIDE tokens, so neighbouring windows overlap.
+MAX_LENGTH = 512
+WINDOW_STRIDE = 384
+# Any whitespace, and the text up to the last whitespace of a range
+WHITESPACE = re.compile(r'\s')
+UP_TO_LAST_WHITESPACE = re.compile(r'.*\s', re.DOTALL)
+# Sentence boundaries: whitespace after closing punctuation, or line breaks
+SENTENCE_BREAK = re.compile(r'((?<=[.!?])\s+|(?<=[.!?]["\')\]])\s+|\s*\n\s*)')
+# Characters of clean text given to BERT on each side of a mask
+CONTEXT_CHARS = 256
+# Characters of a stream recovered at a time, and read from a file at a time
+STREAM_BLOCK_CHARS = 64 * 1024
+# Hash-verified search: candidate words per mask, filled-in regions tried
+# per region, and seconds one recovery may spend searching
+TOP_K = 5
+MAX_CANDIDATES = 2000
+SEARCH_TIME_BUDGET = 10.0
+# How far below a word predicted at a sentence start its capitalised form
+# is scored (log probability), so the word as predicted is tried first
+CAPITALISED_PENALTY = 1e-6
+# Inference backend: 'torch' (fp32), 'quantized' (int8 dynamic) or 'onnx'
+DEFAULT_BACKEND = 'torch'
+# Share of top-1 mask predictions a faster backend must have in common with
+# fp32 on the samples below, or recovery stays on fp32
+BACKEND_AGREEMENT = 0.9
+ACCURACY_SAMPLES = [
+    "The quick brown fox jumps over the lazy {mask}.",
+    "Please send the {mask} to the server before the end of the day.",
+    "The file was {mask} during the transfer and had to be recovered.",
+    "Machine {mask} is a branch of artificial intelligence.",
+    "She opened the {mask} and walked into the room.",
+    "Each block of the file is hashed and the hashes form a {mask} tree.",
+    "The meeting has been moved to {mask} morning at nine o'clock.",
+    "He could not remember where he had left his {mask}.",
+]
 
 class BERTFileRecovery:
     """
     BERT-based file recovery system for text files
     """
     
-    def __init__(self, model_name='bert-base-uncased'):
+    def __init__(self, model_name='bert-base-uncased', batch_size=DEFAULT_BATCH_SIZE,
+                 backend=DEFAULT_BACKEND, check_accuracy=True):
         self.model_name = model_name
+        self.batch_size = batch_size
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         print(f"Initializing BERT File Recovery with {model_name}")
         print(f"Using device: {self.device}")
@@ -34,6 +78,59 @@ class BERTFileRecovery:
             self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
             self.model = BertForMaskedLM.from_pretrained('bert-base-uncased').to(self.device)
             self.model.eval()
+        
+        self.backend = TorchBackend(self.model, self.device, model_name)
+        if backend != TorchBackend.name:
+            self._select_backend(backend, check_accuracy)
+    
+    def _select_backend(self, name, check_accuracy):
+        """
+        Switch to a faster inference backend, staying on fp32 if it cannot
+        be built or its predictions drift too far from fp32's
+        """
+        try:
+            candidate = create_backend(name, self.model, self.device, self.model_name)
+        except ImportError as e:
+            print(f"⚠️ Inference backend '{name}' is not available ({e}), using fp32")
+            return
+        except Exception as e:
+            print(f"⚠️ Could not set up inference backend '{name}': {e}, using fp32")
+            return
+        
+        if check_accuracy:
+            agreement = self.backend_agreement(candidate)
+            print(f"Backend '{name}' agrees with fp32 on {agreement*100:.1f}% of sample predictions")
+            if agreement < BACKEND_AGREEMENT:
+                print(f"⚠️ Below the {BACKEND_AGREEMENT*100:.0f}% required, using fp32")
+                return
+        
+        print(f"✅ Using inference backend '{name}'")
+        self.backend = candidate
+        # The fp32 weights are no longer needed once the backend holds its own copy
+        self.model = None
+    
+    def backend_agreement(self, candidate, samples=None):
+        """
+        Accuracy regression check: how often a backend's top prediction for
+        a mask matches the current backend's
+        
+        Args:
+            candidate: Inference backend to check
+            samples: Texts with a '{mask}' placeholder (default ACCURACY_SAMPLES)
+        
+        Returns:
+            float: Share of masks (0.0 to 1.0) predicted the same by both backends
+        """
+        texts = [sample.format(mask=self.tokenizer.mask_token) for sample in samples or ACCURACY_SAMPLES]
+        reference = self._predict_masks(texts)
+        predicted = self._predict_masks(texts, backend=candidate)
+        
+        total = matches = 0
+        for expected_masks, masks in zip(reference, predicted):
+            for i, expected in enumerate(expected_masks):
+                total += 1
+                matches += i < len(masks) and masks[i][0][0] == expected[0][0]
+        return matches / total if total else 0.0
     
     def corrupt_text_file(self, input_file, output_file, corruption_level=0.15):
         """
@@ -50,16 +147,14 @@ class BERTFileRecovery:
             with open(input_file, 'r', encoding='utf-8') as f:
                 text = f.read()
             
-            # Split into sentences for better processing
-            sentences = text.split('. ')
-            corrupted_sentences = []
-            
-            for sentence in sentences:
-                if sentence.strip():
-                    corrupted_sentence = self._corrupt_sentence(sentence, corruption_level)
-                    corrupted_sentences.append(corrupted_sentence)
+            # Split into sentences for better processing, keeping the breaks
+            # between them (the odd entries) as they are
+            pieces = SENTENCE_BREAK.split(text)
+            for i in range(0, len(pieces), 2):
+                if pieces[i].strip():
+                    pieces[i] = self._corrupt_sentence(pieces[i], corruption_level)
             
-            corrupted_text = '. '.join(corrupted_sentences)
+            corrupted_text = ''.join(pieces)
             
             # Write corrupted file
             with open(output_file, 'w', encoding='utf-8') as f:
@@ -103,66 +198,371 @@ class BERTFileRecovery:
         print(f"Recovering text file: {corrupted_file}")
         
         try:
-            with open(corrupted_file, 'r', encoding='utf-8') as f:
-                corrupted_text = f.read()
-            
-            # Split into sentences for processing
-            sentences = corrupted_text.split('. ')
-            recovered_sentences = []
-            
-            for i, sentence in enumerate(sentences):
-                if sentence.strip():
-                    print(f"Processing sentence {i+1}/{len(sentences)}...")
-                    recovered_sentence = self._recover_sentence(sentence)
-                    recovered_sentences.append(recovered_sentence)
-            
-            recovered_text = '. '.join(recovered_sentences)
-            
-            # Write recovered file
-            with open(recovered_file, 'w', encoding='utf-8') as f:
-                f.write(recovered_text)
+            # Stream from one file to the other so neither is held in memory whole
+            recovered_length = 0
+            with open(corrupted_file, 'r', encoding='utf-8') as source, \
+                    open(recovered_file, 'w', encoding='utf-8') as target:
+                for piece in self.recover_stream(iter(lambda: source.read(STREAM_BLOCK_CHARS), '')):
+                    target.write(piece)
+                    recovered_length += len(piece)
             
             print(f"✅ Recovered file saved to: {recovered_file}")
-            return len(recovered_text)
+            return recovered_length
             
         except Exception as e:
             print(f"❌ Error recovering file: {e}")
             return 0
     
-    def _recover_sentence(self, sentence):
+    def recover_text(self, text, context_chars=CONTEXT_CHARS):
         """
-        Recover a single sentence using BERT
+        Recover the masked words in a text using BERT
+        
+        Only the spans around mask tokens are given to the model, each with
+        `context_chars` of surrounding text on either side (spans that
+        overlap are merged). Everything outside the masks is returned
+        exactly as it was.
+        
+        Args:
+            text: Corrupted text
+            context_chars: Characters of context kept on each side of a mask
+        
+        Returns:
+            str: Text with every mask replaced by BERT's prediction
         """
-        try:
-            # Tokenize the sentence
-            inputs = self.tokenizer(sentence, return_tensors='pt', truncation=True, max_length=512)
-            input_ids = inputs['input_ids'].to(self.device)
-            
-            # Find mask tokens
-            mask_token_index = (input_ids == self.tokenizer.mask_token_id)[0].nonzero(as_tuple=True)[0]
-            
-            if len(mask_token_index) == 0:
-                return sentence  # No masks to recover
-            
-            # Get predictions
-            with torch.no_grad():
-                outputs = self.model(**inputs)
-                logits = outputs.logits
-            
-            # Replace masks with predictions
-            recovered_ids = input_ids.clone()
-            for idx in mask_token_index:
-                mask_logits = logits[0, idx]
-                predicted_token_id = mask_logits.argmax().item()
-                recovered_ids[0, idx] = predicted_token_id
+        spans = self._masked_spans(text, context_chars)
+        if not spans:
+            return text
+        print(f"Found {text.count(self.tokenizer.mask_token)} masked words in {len(spans)} spans")
+        
+        recovered = self.recover_sentences([text[start:end] for start, end in spans])
+        pieces = []
+        previous_end = 0
+        for (start, end), span in zip(spans, recovered):
+            pieces.append(text[previous_end:start])
+            pieces.append(span)
+            previous_end = end
+        pieces.append(text[previous_end:])
+        return ''.join(pieces)
+    
+    def recover_stream(self, chunks, context_chars=CONTEXT_CHARS, block_chars=STREAM_BLOCK_CHARS):
+        """
+        Recover the masked words in text arriving in pieces, yielding the
+        recovered text as it goes
+        
+        The text is recovered a block of about `block_chars` at a time,
+        each block cut at whitespace and given `context_chars` of the text
+        on either side as context, so memory stays bounded however long the
+        stream is. Text outside the masks comes out exactly as it went in.
+        
+        Args:
+            chunks: Iterable of strings making up the corrupted text
+            context_chars: Characters of context on each side of a block
+            block_chars: Characters recovered at a time
+        
+        Yields:
+            str: Consecutive pieces of the recovered text
+        """
+        mask = self.tokenizer.mask_token
+        before = ''
+        pending = ''
+        for chunk in chunks:
+            pending += chunk
+            while len(pending) >= block_chars + context_chars + len(mask):
+                last_space = UP_TO_LAST_WHITESPACE.match(pending, block_chars // 2, block_chars)
+                cut = last_space.end() if last_space else block_chars
+                # Never cut through a mask token: look for one starting just
+                # before the cut and ending after it
+                overlap = pending.find(mask, max(0, cut - len(mask) + 1), cut + len(mask) - 1)
+                if overlap != -1:
+                    cut = overlap
+                block = pending[:cut]
+                yield self._recover_block(before, block, pending[cut:], context_chars)
+                before = (before + block)[-context_chars:]
+                pending = pending[cut:]
+        
+        if pending:
+            yield self._recover_block(before, pending, '', context_chars)
+    
+    def _recover_block(self, before, block, after, context_chars):
+        """
+        Recover the masks in one block of a stream, giving the model only
+        the spans around them so the work grows with the number of masks
+        rather than the size of the block
+        """
+        spans = self._masked_spans(block, context_chars)
+        if not spans:
+            return block
+        regions = [(before[-context_chars:] + block[max(0, start - context_chars):start], block[start:end],
+                    block[end:end + context_chars] + after[:context_chars])
+                   for start, end in spans]
+        recovered = self.recover_regions(regions, context_chars=context_chars)
+        pieces = []
+        previous_end = 0
+        for (start, end), region in zip(spans, recovered):
+            pieces.append(block[previous_end:start])
+            pieces.append(region)
+            previous_end = end
+        pieces.append(block[previous_end:])
+        return ''.join(pieces)
+    
+    def _masked_spans(self, text, context_chars):
+        """
+        Find the (start, end) character ranges around every mask token,
+        widened by the context and cut at whitespace so no word is split
+        """
+        mask = self.tokenizer.mask_token
+        spans = []
+        position = text.find(mask)
+        while position != -1:
+            start = max(0, position - context_chars)
+            end = min(len(text), position + len(mask) + context_chars)
+            if start > 0:
+                space = WHITESPACE.search(text, start, position)
+                start = space.end() if space else position
+            if end < len(text):
+                space = UP_TO_LAST_WHITESPACE.match(text, position + len(mask), end)
+                end = space.end() - 1 if space else position + len(mask)
             
-            # Decode back to text
-            recovered_text = self.tokenizer.decode(recovered_ids[0], skip_special_tokens=True)
-            return recovered_text
+            if spans and start <= spans[-1][1]:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+            position = text.find(mask, position + len(mask))
+        return spans
+    
+    def recover_sentences(self, sentences, batch_size=None):
+        """
+        Recover many sentences using BERT, several per forward pass
+        
+        Sentences without a mask token are returned as they are. In the
+        rest each mask is replaced by the predicted word while the rest of
+        the sentence is kept as written.
+        
+        Args:
+            sentences: List of sentences to recover
+            batch_size: Sentences per forward pass (default: self.batch_size)
+        
+        Returns:
+            list: Recovered sentences, in the same order as the input
+        """
+        predictions = self._predict_masks(sentences, batch_size)
+        return [self._fill_masks(sentence, [candidates[0][0] for candidates in masks])
+                for sentence, masks in zip(sentences, predictions)]
+    
+    def recover_regions(self, regions, verify=None, top_k=TOP_K, max_candidates=MAX_CANDIDATES,
+                        time_budget=SEARCH_TIME_BUDGET, context_chars=CONTEXT_CHARS, batch_size=None):
+        """
+        Recover the masks inside regions of a text, using the text around
+        each region as context without changing it
+        
+        Without `verify` each mask gets BERT's most likely word. With it,
+        the `top_k` words for every mask are searched best-first in order of
+        joint likelihood until a filled-in region passes `verify`, trying at
+        most `max_candidates` per region and stopping all searches once
+        `time_budget` seconds have passed.
+        
+        Args:
+            regions: List of (before, region, after) strings
+            verify: Optional callable (region index, recovered region) -> bool
+            top_k: Candidate words considered per mask when searching
+            max_candidates: Filled-in regions tried per region when searching
+            time_budget: Seconds all searches of one call may take
+            context_chars: Characters of `before` and `after` given to the model
+            batch_size: Regions per forward pass (default: self.batch_size)
+        
+        Returns:
+            list: Recovered regions, in the same order as the input. When
+            searching, regions with no verified candidate are None.
+        """
+        mask = self.tokenizer.mask_token
+        contexts = [(before[-context_chars:] if context_chars else '', after[:context_chars])
+                    for before, _, after in regions]
+        texts = [before + region + after for (before, after), (_, region, _) in zip(contexts, regions)]
+        predictions = self._predict_masks(texts, batch_size, top_k if verify else 1)
+        
+        deadline = time.monotonic() + time_budget
+        recovered = []
+        for i, ((before, _), (_, region, _), masks) in enumerate(zip(contexts, regions, predictions)):
+            # Skip the predictions for masks in the leading context
+            masks = masks[before.count(mask):]
+            if verify is None:
+                recovered.append(self._fill_masks(region, [candidates[0][0] for candidates in masks]))
+            else:
+                recovered.append(self._search_masks(before, region, masks, lambda text: verify(i, text),
+                                                    max_candidates, deadline))
+        return recovered
+    
+    def _search_masks(self, before, region, masks, verify, max_candidates, deadline):
+        """
+        Best-first search over the combinations of candidate words for the
+        masks of a region, most likely combination first
+        
+        Returns:
+            str: The first filled-in region that passes `verify`, or None
+        """
+        parts = region.split(self.tokenizer.mask_token)
+        if len(masks) < len(parts) - 1:
+            # Some masks have no candidates (their batch failed)
+            return None
+        masks = masks[:len(parts) - 1]
+        
+        # The uncased model predicts lowercase words. Where a sentence starts
+        # the capitalised form is tried too, right after the word as predicted
+        for position, candidates in enumerate(masks):
+            preceding = (before + parts[0] if position == 0 else parts[position]).rstrip()
+            if not preceding or preceding[-1] in '.!?':
+                extended = []
+                for word, score in candidates:
+                    extended.append((word, score))
+                    capitalised = word[:1].upper() + word[1:]
+                    if capitalised != word:
+                        extended.append((capitalised, score - CAPITALISED_PENALTY))
+                masks[position] = sorted(extended, key=lambda candidate: -candidate[1])
+        
+        start = (0,) * len(masks)
+        heap = [(-sum(candidates[0][1] for candidates in masks), start)]
+        seen = {start}
+        tried = 0
+        while heap and tried < max_candidates and time.monotonic() < deadline:
+            _, choice = heapq.heappop(heap)
+            text = self._fill_masks(region, [masks[position][index][0] for position, index in enumerate(choice)])
+            tried += 1
+            if verify(text):
+                print(f"  ✅ Verified candidate found after {tried} tries")
+                return text
             
-        except Exception as e:
-            print(f"  ⚠️ Error recovering sentence: {e}")
-            return sentence  # Return original if recovery fails
+            # Successors swap one mask to its next most likely word
+            for position, index in enumerate(choice):
+                if index + 1 < len(masks[position]):
+                    successor = choice[:position] + (index + 1,) + choice[position + 1:]
+                    if successor not in seen:
+                        seen.add(successor)
+                        score = sum(masks[p][i][1] for p, i in enumerate(successor))
+                        heapq.heappush(heap, (-score, successor))
+        
+        print(f"  ❌ No verified candidate after {tried} tries")
+        return None
+    
+    def _predict_masks(self, texts, batch_size=None, top_k=1, backend=None):
+        """
+        Predict the words behind every mask token in each text
+        
+        Texts without a mask token are not tokenized. Texts longer than the
+        model's input are cut into overlapping windows, and each mask is
+        predicted in the window where it has the most context on both sides.
+        Windows are grouped by token length so each padded batch wastes
+        little work.
+        
+        Returns:
+            list: For each text, one list per mask (in order) of up to
+            `top_k` (word, log probability) pairs, most likely first. Empty
+            if the text has no masks; cut short at the first mask whose
+            batch failed.
+        """
+        batch_size = batch_size or self.batch_size
+        backend = backend or self.backend
+        predictions = [[] for _ in texts]
+        masked = [i for i, text in enumerate(texts) if self.tokenizer.mask_token in text]
+        if not masked:
+            return predictions
+        
+        # Tokenize once up front, then cut each text into the windows its masks need
+        mask_id = self.tokenizer.mask_token_id
+        body = MAX_LENGTH - self.tokenizer.num_special_tokens_to_add()
+        encodings = self.tokenizer([texts[i] for i in masked], add_special_tokens=False)['input_ids']
+        windows = []    # (text, mask positions covered, input ids)
+        positions = []  # mask positions of each text
+        owners = []     # {mask position: window predicting it} for each text
+        for k, ids in enumerate(encodings):
+            positions.append([p for p, token in enumerate(ids) if token == mask_id])
+            chosen = {}
+            owner = {}
+            for p, start in zip(positions[k], self._window_starts(len(ids), positions[k], body)):
+                if start not in chosen:
+                    chosen[start] = len(windows)
+                    covered = [q for q in positions[k] if start <= q < start + body]
+                    windows.append((k, covered, self.tokenizer.build_inputs_with_special_tokens(ids[start:start + body])))
+                owner[p] = chosen[start]
+            owners.append(owner)
+        
+        results = [{} for _ in masked]
+        order = sorted(range(len(windows)), key=lambda w: len(windows[w][2]))
+        batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+        for number, batch in enumerate(batches):
+            print(f"Processing batch {number+1}/{len(batches)} ({len(batch)} windows)...")
+            try:
+                inputs = self.tokenizer.pad({'input_ids': [windows[w][2] for w in batch]}, return_tensors='pt')
+                
+                # Get predictions for the whole batch
+                logits = backend.logits(inputs['input_ids'], inputs['attention_mask'])
+                
+                # Take the top predictions at the mask positions and keep those
+                # of the masks each window was chosen for
+                mask_positions = (inputs['input_ids'] == mask_id).to(logits.device)
+                for row, w in enumerate(batch):
+                    k, covered, _ = windows[w]
+                    log_probs = torch.log_softmax(logits[row][mask_positions[row]], dim=-1)
+                    scores, token_ids = log_probs.topk(top_k, dim=-1)
+                    for p, ids, mask_scores in zip(covered, token_ids.tolist(), scores.tolist()):
+                        if owners[k][p] == w:
+                            results[k][p] = list(zip(self._predicted_words(ids), mask_scores))
+            except Exception as e:
+                print(f"  ⚠️ Error recovering batch: {e}")
+                # Leave the masks of this batch in place if recovery fails
+        
+        for k, i in enumerate(masked):
+            for p in positions[k]:
+                if p not in results[k]:
+                    break
+                predictions[i].append(results[k][p])
+        return predictions
+    
+    def _window_starts(self, length, positions, body):
+        """
+        Choose the window each mask is predicted in. Windows of `body`
+        tokens start every WINDOW_STRIDE tokens, the last one ending at the
+        end of the text, and a mask goes to the window it is most central in.
+        
+        Returns:
+            list: The first token of the chosen window for each mask position
+        """
+        if length <= body:
+            return [0] * len(positions)
+        starts = list(range(0, length - body, WINDOW_STRIDE)) + [length - body]
+        chosen = []
+        for p in positions:
+            nearest = min(max((p - body // 2) // WINDOW_STRIDE, 0), len(starts) - 1)
+            candidates = starts[nearest:nearest + 2] + starts[-1:]
+            chosen.append(max(candidates, key=lambda start: min(p - start, start + body - 1 - p)))
+        return chosen
+    
+    def _predicted_words(self, token_ids):
+        """
+        Turn predicted token IDs into the words that replace the masks
+        """
+        words = []
+        for token in self.tokenizer.convert_ids_to_tokens(token_ids):
+            # A predicted word piece stands in for a whole masked word
+            words.append(token[2:] if token.startswith('##') else token)
+        return words
+    
+    def _fill_masks(self, text, words):
+        """
+        Replace the mask tokens in a text with words, in order. Masks past
+        the end of `words` (whose batch failed) are left in place.
+        """
+        parts = text.split(self.tokenizer.mask_token)
+        pieces = [parts[0]]
+        for i, part in enumerate(parts[1:]):
+            pieces.append(words[i] if i < len(words) else self.tokenizer.mask_token)
+            pieces.append(part)
+        return ''.join(pieces)
+    
+    def _recover_sentence(self, sentence):
+        """
+        Recover a single sentence using BERT
+        """
+        return self.recover_sentences([sentence])[0]
     
     def compare_files(self, original_file, recovered_file):
         """
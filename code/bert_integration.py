@@ -6,7 +6,8 @@ Enhanced with PDF and DOCX support
 
 import os
 import logging
-from bert_file_recovery import BERTFileRecovery
+from hashlib import sha256
+from bert_file_recovery import BERTFileRecovery, DEFAULT_BACKEND
 from file_processor import FileProcessor
 
 # Configure logging
@@ -19,8 +20,8 @@ class BERTRecoveryIntegration:
     Enhanced with PDF and DOCX support
     """
     
-    def __init__(self, model_name='bert-base-uncased'):
-        self.recovery_system = BERTFileRecovery(model_name)
+    def __init__(self, model_name='bert-base-uncased', backend=DEFAULT_BACKEND):
+        self.recovery_system = BERTFileRecovery(model_name, backend=backend)
         self.file_processor = FileProcessor()
         self.supported_extensions = self.file_processor.get_supported_formats()
     
@@ -48,6 +49,13 @@ class BERTRecoveryIntegration:
         """
         return self.file_processor.extract_text(file_path)
     
+    def _iter_text(self, file_path):
+        """
+        The text of a file, piece by piece as it is extracted
+        """
+        for _, piece in self.file_processor.iter_text(file_path):
+            yield piece
+    
     def recover_corrupted_text_file(self, corrupted_file_path, output_path=None):
         """
         Recover a corrupted text file using BERT
@@ -68,19 +76,6 @@ class BERTRecoveryIntegration:
                 logger.error(f"Corrupted file not found: {corrupted_file_path}")
                 return False, None, 0.0
             
-            # Extract text from the file
-            logger.info(f"Extracting text from: {corrupted_file_path}")
-            extracted_text = self.extract_text_from_file(corrupted_file_path)
-            
-            if not extracted_text:
-                logger.error(f"Failed to extract text from: {corrupted_file_path}")
-                return False, None, 0.0
-            
-            # Create a temporary text file for BERT processing
-            temp_text_file = f"{corrupted_file_path}_temp.txt"
-            with open(temp_text_file, 'w', encoding='utf-8') as f:
-                f.write(extracted_text)
-            
             # Generate output path if not provided
             if output_path is None:
                 base_name = os.path.splitext(corrupted_file_path)[0]
@@ -88,17 +83,18 @@ class BERTRecoveryIntegration:
             
             logger.info(f"Attempting to recover text file: {corrupted_file_path}")
             
-            # Recover the text file using BERT
-            recovered_length = self.recovery_system.recover_text_file(temp_text_file, output_path)
-            
-            # Clean up temporary file
-            if os.path.exists(temp_text_file):
-                os.remove(temp_text_file)
+            # Extract, recover and write the text as a pipeline, a piece at a time
+            recovered_length = 0
+            with open(output_path, 'w', encoding='utf-8') as f:
+                for piece in self.recovery_system.recover_stream(self._iter_text(corrupted_file_path)):
+                    f.write(piece)
+                    recovered_length += len(piece)
             
             if recovered_length > 0:
                 logger.info(f"✅ Successfully recovered file to: {output_path}")
                 return True, output_path, 1.0  # Assuming successful recovery
             else:
+                os.remove(output_path)
                 logger.error(f"❌ Failed to recover file: {corrupted_file_path}")
                 return False, None, 0.0
                 
@@ -125,36 +121,10 @@ class BERTRecoveryIntegration:
                 logger.error(f"File not found: {file_path}")
                 return None
             
-            # Extract text from the original file
-            original_text = self.extract_text_from_file(file_path)
-            if not original_text:
-                logger.error(f"Failed to extract text from: {file_path}")
-                return None
+            # Recover the text as it is extracted
+            recovered_content = ''.join(self.recovery_system.recover_stream(self._iter_text(file_path)))
             
-            # Create a temporary text file for BERT processing
-            temp_text_file = f"{file_path}_temp.txt"
-            with open(temp_text_file, 'w', encoding='utf-8') as f:
-                f.write(original_text)
-            
-            # Create a temporary recovered file
-            temp_recovered_path = f"{file_path}_temp_recovered.txt"
-            
-            # Attempt recovery
-            recovered_length = self.recovery_system.recover_text_file(temp_text_file, temp_recovered_path)
-            
-            # Clean up temporary text file
-            if os.path.exists(temp_text_file):
-                os.remove(temp_text_file)
-            
-            if recovered_length > 0:
-                # Read the recovered content
-                with open(temp_recovered_path, 'r', encoding='utf-8') as f:
-                    recovered_content = f.read()
-                
-                # Clean up temporary recovered file
-                if os.path.exists(temp_recovered_path):
-                    os.remove(temp_recovered_path)
-                
+            if recovered_content:
                 logger.info(f"✅ Successfully recovered file: {file_path}")
                 return recovered_content
             else:
@@ -165,6 +135,61 @@ class BERTRecoveryIntegration:
             logger.error(f"Error during file recovery: {e}")
             return None
     
+    def recover_leaves(self, file_path, expected_digests, leaf_size):
+        """
+        Recover individual Merkle leaves of a plain text file in place
+        
+        Only the damaged leaves are given to BERT, each with the text of
+        its neighbouring leaves as context. BERT's top predictions for the
+        masks in a leaf are searched until the filled-in leaf hashes to the
+        digest the client sent for it.
+        
+        Args:
+            file_path: Path to the corrupted file
+            expected_digests: {leaf index: expected raw sha256 digest}
+            leaf_size: Size of a Merkle leaf in bytes
+        
+        Returns:
+            dict: {leaf index: recovered leaf bytes} for every leaf that now
+            matches its expected digest
+        """
+        try:
+            if not self.file_processor.is_plain_text(file_path):
+                logger.warning(f"File {file_path} is not plain text, leaves cannot be recovered in place")
+                return {}
+            
+            indices = sorted(expected_digests)
+            regions = []
+            with open(file_path, 'rb') as f:
+                for index in indices:
+                    start = max(0, index - 1) * leaf_size
+                    f.seek(start)
+                    data = f.read((index + 2) * leaf_size - start)
+                    offset = index * leaf_size - start
+                    # surrogateescape keeps undecodable bytes (such as a character
+                    # split across leaves) so the leaf encodes back to the same bytes
+                    regions.append(tuple(part.decode('utf-8', errors='surrogateescape') for part in
+                                         (data[:offset], data[offset:offset + leaf_size], data[offset + leaf_size:])))
+            
+            def verify(i, leaf):
+                try:
+                    return sha256(leaf.encode('utf-8', errors='surrogateescape')).digest() == expected_digests[indices[i]]
+                except UnicodeEncodeError:
+                    return False
+            
+            logger.info(f"Attempting to recover {len(indices)} damaged leaves of {file_path}")
+            recovered = {}
+            for index, leaf in zip(indices, self.recovery_system.recover_regions(regions, verify=verify)):
+                if leaf is not None:
+                    recovered[index] = leaf.encode('utf-8', errors='surrogateescape')
+            
+            logger.info(f"Recovered {len(recovered)}/{len(indices)} leaves of {file_path}")
+            return recovered
+            
+        except Exception as e:
+            logger.error(f"Error during leaf recovery: {e}")
+            return {}
+    
     def batch_recover_directory(self, input_directory, output_directory):
         """
         Recover all supported files in a directory
@@ -0,0 +1,133 @@
+'''
+Content-Defined Chunking for the Secure File Transfer System
+Splits files at boundaries chosen by a rolling gear hash, so an edit only
+changes the chunks around it and the rest can be deduplicated
+'''
+
+from collections import deque
+from hashlib import sha256
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+# 13 high bits of the hash must be zero at a boundary, giving chunks of
+# about 8 KB past the minimum size
+BOUNDARY_MASK = 0xFFF80000
+
+# The gear hash is h = (h << 1) + GEAR[byte] kept to 32 bits, so each
+# position's hash only depends on the 32 bytes ending there
+WINDOW = 32
+HASH_BITS = 0xFFFFFFFF
+GEAR = tuple(int.from_bytes(sha256(bytes([i])).digest()[:4], 'big') for i in range(256))
+
+
+class ContentChunker:
+    """
+    Incrementally splits a byte stream into content-defined chunks.
+
+    A boundary is placed after any position whose rolling hash matches the
+    boundary mask, as long as the chunk is at least `min_size` bytes, and
+    chunks are cut at `max_size` regardless. Because the hash only looks at
+    the last 32 bytes, the same content always produces the same boundaries
+    no matter where it sits in the file.
+    """
+
+    def __init__(self, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, mask=BOUNDARY_MASK):
+        if min_size < WINDOW:
+            raise ValueError(f"Minimum chunk size must be at least {WINDOW} bytes")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = mask
+        self._buffer = bytearray()
+        self._start = 0
+        self._offset = 0
+        self._candidates = deque()
+        self._hash = 0
+        self._history = np.zeros(WINDOW - 1, dtype=np.uint32) if np is not None else None
+
+    def update(self, data):
+        """
+        Feed the next piece of the stream
+
+        Returns:
+            list: (length, raw sha256 digest) of every chunk completed so far
+        """
+        if np is not None:
+            self._scan_numpy(data)
+        else:
+            self._scan(data)
+        self._buffer += data
+        self._offset += len(data)
+        return self._cut(final=False)
+
+    def finish(self):
+        """
+        Close the stream and return the remaining chunks
+        """
+        return self._cut(final=True)
+
+    def _scan(self, data):
+        h = self._hash
+        mask = self.mask
+        gear = GEAR
+        candidates = self._candidates
+        pos = self._offset
+        for byte in data:
+            h = ((h << 1) + gear[byte]) & HASH_BITS
+            pos += 1
+            if not h & mask:
+                candidates.append(pos)
+        self._hash = h
+
+    def _scan_numpy(self, data):
+        if not data:
+            return
+        # Window hashes for every position, built by doubling the window:
+        # h_2k[i] = (h_k[i - k] << k) + h_k[i]
+        gear = np.asarray(GEAR, dtype=np.uint32)[np.frombuffer(data, dtype=np.uint8)]
+        h = np.concatenate((self._history, gear))
+        span = 1
+        while span < WINDOW:
+            shifted = np.zeros_like(h)
+            shifted[span:] = h[:-span] << np.uint32(span)
+            h = shifted + h
+            span *= 2
+        h = h[WINDOW - 1:]
+
+        matches = np.flatnonzero((h & np.uint32(self.mask)) == 0)
+        self._candidates.extend((matches + self._offset + 1).tolist())
+        self._history = np.concatenate((self._history, gear))[-(WINDOW - 1):]
+
+    def _cut(self, final):
+        chunks = []
+        candidates = self._candidates
+        end_of_data = self._offset
+        while True:
+            while candidates and candidates[0] - self._start < self.min_size:
+                candidates.popleft()
+            if candidates and candidates[0] - self._start <= self.max_size:
+                end = candidates.popleft()
+            elif end_of_data - self._start >= self.max_size:
+                end = self._start + self.max_size
+            elif final and end_of_data > self._start:
+                end = end_of_data
+            else:
+                break
+
+            length = end - self._start
+            chunks.append((length, sha256(self._buffer[:length]).digest()))
+            del self._buffer[:length]
+            self._start = end
+        return chunks
+
+
+def chunk_bytes(data, **kwargs):
+    """
+    Split an in-memory byte string into content-defined chunks
+    """
+    chunker = ContentChunker(**kwargs)
+    return chunker.update(data) + chunker.finish()
@@ -15,6 +15,19 @@ import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import time
+import sys
+
+# Add the parent directory to path to import the shared transfer protocol
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from transfer_protocol import (PROTOCOL_VERSION, VERSION_SEPARATOR, ProtocolError, offer_transfer_type, parse_transfer_type,
+                               send_text, recv_text, recv_offer, send_bitmap, recv_bitmap, send_manifest)
+from merkle import LEAF_SIZE, LeafHasher, MerkleTree
+from merkle_sync import serve_repair_requests
+from transfer_state import TransferState, missing_blocks, send_blocks, receive_blocks
+from chunking import ContentChunker
+from channel_cipher import ChannelCipher
+from event_store import EventStore
 
 # Configure Streamlit page
 st.set_page_config(
@@ -327,6 +340,14 @@ load_css()
 SIZE = 102400
 PORT = 4455
 KEY = 'epVKiOHn7J0sZcJ4-buWQ5ednv3csHdQHfvEKk0qVvk='
+# Framed transfers send raw AES-GCM encrypted bytes under a key derived from KEY
+cipher = ChannelCipher(KEY)
+# Plaintext bytes read, encrypted and sent per block when uploading
+STREAM_CHUNK_SIZE = 64 * 1024
+# Connection attempts per transfer; each retry resumes where the last one stopped
+TRANSFER_ATTEMPTS = 3
+# Seconds to wait before reconnecting after a dropped transfer
+RETRY_DELAY = 1
 
 # Animation helper
 def show_loading_animation(message="Processing..."):
@@ -353,7 +374,7 @@ def create_metric_card(value, label, color_class="metric-card"):
     </div>
     """
 
-# Function to encrypt data using Fernet symmetric encryption
+# Function to encrypt data using Fernet symmetric encryption (legacy servers)
 def encrypt_data(data):
     fernet = Fernet(KEY)
     if isinstance(data, str):
@@ -361,7 +382,7 @@ def encrypt_data(data):
     encMessage = fernet.encrypt(data)
     return encMessage
 
-# Function to decrypt data using Fernet symmetric encryption
+# Function to decrypt data using Fernet symmetric encryption (legacy servers)
 def decrypt_data(data):
     fernet = Fernet(KEY)
     if isinstance(data, str):
@@ -399,7 +420,8 @@ def chunk_file(file_path, chunk_size):
                         break
     return chunks
 
-# Function to create a Merkle tree from file chunks
+# Function to create a Merkle tree from file chunks. Only used with legacy
+# servers, framed transfers are hashed with merkle.MerkleTree.
 def merkle_tree(chunks):
     if len(chunks) == 1:
         return sha256(chunks[0].encode()).hexdigest()
@@ -417,7 +439,7 @@ def show_files(ip):
     try:
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.connect(ADDR)
-        client.send("Show".encode())
+        client.send(offer_transfer_type("Show").encode())
         msg = client.recv(SIZE).decode()
         print(msg)
         
@@ -431,15 +453,96 @@ def show_files(ip):
     print("File names Received")
     return file_names
 
-def upload_file(uploaded_file, ip):
+# Hashes the file to upload into its Merkle tree and splits it into
+# content-defined chunks. The root and chunk list are sent to the server
+# before any data, so only chunks it does not already have are uploaded.
+def hash_upload(file_obj):
+    file_obj.seek(0)
+    leaves = LeafHasher()
+    chunker = ContentChunker()
+    chunks = []
+    while True:
+        chunk = file_obj.read(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        leaves.update(chunk)
+        chunks += chunker.update(chunk)
+    chunks += chunker.finish()
+    total_length = file_obj.tell()
+    return MerkleTree(leaves.finish()), total_length, chunks
+
+# Sends the file as content-defined chunks, skipping the chunks the server
+# already holds from an earlier revision or an interrupted attempt, so
+# neither the file nor its ciphertext is held in memory as a whole
+def send_file_chunks(client, file_obj, tree, total_length, chunks):
+    send_manifest(client, tree.root, total_length, chunks)
+    missing = missing_blocks(recv_bitmap(client), len(chunks))
+    if len(missing) < len(chunks):
+        print(f"Skipping {len(chunks) - len(missing)}/{len(chunks)} chunks already on the server")
+
+    offsets = []
+    offset = 0
+    for length, _ in chunks:
+        offsets.append(offset)
+        offset += length
+
+    def read_chunk(index):
+        file_obj.seek(offsets[index])
+        return file_obj.read(chunks[index][0])
+
+    send_blocks(client, missing, read_chunk, cipher.encrypt)
+
+# Receives a file in encrypted blocks into a partial download, telling the
+# server which blocks were kept from an earlier attempt. The file is only
+# moved into place once its Merkle root matches the one the server offered.
+# Returns the offered root hash and the root hash of the received data.
+def receive_file_blocks(client, file_path):
+    root, total_length, block_size = recv_offer(client)
+    state = TransferState(os.path.join("Downloaded", ".partial"), root.hex(), total_length, block_size)
+    if state.resumed_blocks:
+        print(f"Resuming download: {state.resumed_blocks}/{state.block_count} blocks already downloaded")
+    send_bitmap(client, state.bitmap)
+    receive_blocks(client, state, cipher.decrypt)
+    if not state.complete:
+        # Blocks that failed decryption are fetched again on reconnecting
+        raise ConnectionError(f"{len(state.missing())} blocks were not received intact")
+
+    tree = MerkleTree.from_file(state.part_path)
+    if tree.root == root:
+        state.commit(file_path)
+    else:
+        state.discard()
+    return root.hex(), tree.root_hex
+
+# Reads a single Merkle leaf back from the uploaded file when the server
+# asks for it to be retransmitted
+def read_leaf(file_obj, index):
+    file_obj.seek(index * LEAF_SIZE)
+    return file_obj.read(LEAF_SIZE)
+
+# Sends a status message to the server, framed when the connection
+# uses the framed protocol
+def send_status(client, text, version):
+    if version >= PROTOCOL_VERSION:
+        send_text(client, text)
+    else:
+        client.send(text.encode())
+
+# Receives a status message from the server, framed the same way
+def recv_status(client, version):
+    if version >= PROTOCOL_VERSION:
+        return recv_text(client)
+    return client.recv(SIZE).decode()
+
+def upload_file(uploaded_file, ip, attempts=TRANSFER_ATTEMPTS, prepared=None):
     IP = socket.gethostbyname(socket.gethostname()) 
     ADDR = (IP, PORT)
 
     try:
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.connect(ADDR)
-        client.send("Upload".encode())
-        msg = client.recv(SIZE).decode()
+        client.send(offer_transfer_type("Upload").encode())
+        msg, version = parse_transfer_type(client.recv(SIZE).decode())
         print(msg)
         
     except:
@@ -450,34 +553,66 @@ def upload_file(uploaded_file, ip):
     msg = client.recv(SIZE).decode()
     print(f"Server: {msg}")
 
-    data = uploaded_file.read()
-    if isinstance(data, bytes):
+    if version >= PROTOCOL_VERSION:
+        if prepared is None:
+            prepared = hash_upload(uploaded_file)
+        tree, total_length, chunks = prepared
+        hash1 = tree.root_hex
+        print(f"Hash value: {hash1}")
         try:
-            data = data.decode('utf-8')
-        except UnicodeDecodeError:
+            send_file_chunks(client, uploaded_file, tree, total_length, chunks)
+        except OSError as e:
+            # The server keeps the chunks it received, reconnect and send the rest
+            client.close()
+            if attempts > 1:
+                print(f"Connection lost during upload ({e}), resuming...")
+                time.sleep(RETRY_DELAY)
+                return upload_file(uploaded_file, ip, attempts - 1, prepared)
+            show_error_message("Upload failed due to connection issues.")
+            return False
+        except ProtocolError as e:
+            print(f"Error during upload: {e}")
+            client.close()
+            show_error_message("Upload rejected by the server.")
+            return False
+    else:
+        data = uploaded_file.read()
+        if isinstance(data, bytes):
             try:
-                data = data.decode('latin-1')
-            except:
-                data = data.decode('cp1252', errors='ignore')
-    
-    encrypted_data = encrypt_data(data)
-    encrypted_data_base64 = base64.b64encode(encrypted_data).decode('utf-8')
-    send_large_data(client, encrypted_data_base64.encode())
+                data = data.decode('utf-8')
+            except UnicodeDecodeError:
+                try:
+                    data = data.decode('latin-1')
+                except:
+                    data = data.decode('cp1252', errors='ignore')
+        
+        encrypted_data = encrypt_data(data)
+        encrypted_data_base64 = base64.b64encode(encrypted_data).decode('utf-8')
+        send_large_data(client, encrypted_data_base64.encode())
 
-    chunks = [data[i:i+1024] for i in range(0, len(data), 1024)]
-    hash1 = merkle_tree(chunks)
-    print(f"Hash value: {hash1}")
+        chunks = [data[i:i+1024] for i in range(0, len(data), 1024)]
+        hash1 = merkle_tree(chunks)
+        print(f"Hash value: {hash1}")
 
-    client.send(hash1.encode())
+        client.send(hash1.encode())
 
     try:
-        secure = client.recv(SIZE).decode()
+        if version >= PROTOCOL_VERSION:
+            # Resend any leaves the server could not verify
+            serve_repair_requests(client, tree, lambda index: read_leaf(uploaded_file, index), cipher.encrypt)
+
+        secure = recv_status(client, version)
         if secure == "True":
             show_success_message("Data Integrity assured!")
+        elif secure.startswith("Recovering"):
+            # The server is recovering the file with BERT in the background
+            job_id = secure.partition(VERSION_SEPARATOR)[2]
+            remember_recovery_job(uploaded_file.name, job_id)
+            st.info(f"🔄 Integrity check failed, BERT recovery is running on the server (job {job_id})")
         else:
             show_error_message("Data might be lost.")
         
-        msg = client.recv(SIZE).decode()
+        msg = recv_status(client, version)
         print(f"Server: {msg}")
         
         client.close()
@@ -490,7 +625,43 @@ def upload_file(uploaded_file, ip):
         show_error_message("Upload failed due to connection issues.")
         return False
 
-def download_file(filename, ip):
+# Keeps the recovery jobs started by uploads in this session, so their
+# outcome can be checked later
+def remember_recovery_job(filename, job_id):
+    st.session_state.setdefault('recovery_jobs', {})[filename] = job_id
+
+# Asks the server how a BERT recovery job is going.
+# Returns the job state and its details.
+def recovery_status(job_id, ip):
+    IP = socket.gethostbyname(socket.gethostname()) 
+    ADDR = (IP, PORT)
+
+    try:
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(ADDR)
+        client.send(offer_transfer_type("Status").encode())
+        msg, version = parse_transfer_type(client.recv(SIZE).decode())
+        print(msg)
+    except:
+        show_error_message("Connection Failure! Check if the server is active.")
+        return "Unknown", "Server unreachable"
+
+    if version < PROTOCOL_VERSION:
+        client.close()
+        return "Unknown", "Server does not report recovery status"
+
+    try:
+        client.send(job_id.encode())
+        state = recv_status(client, version)
+        details = recv_status(client, version)
+        return state, details
+    except Exception as e:
+        print(f"Error during status query: {e}")
+        return "Unknown", "Status query failed"
+    finally:
+        client.close()
+
+def download_file(filename, ip, attempts=TRANSFER_ATTEMPTS):
     try:
         IP = socket.gethostbyname(socket.gethostname()) 
         ADDR = (IP, PORT)
@@ -498,44 +669,58 @@ def download_file(filename, ip):
         try:
             client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             client.connect(ADDR)
-            client.send("Download".encode())
-            msg = client.recv(SIZE).decode()
+            client.send(offer_transfer_type("Download").encode())
+            msg, version = parse_transfer_type(client.recv(SIZE).decode())
             print(msg)
         except:
             show_error_message("Connection Failure! Check if the server is active.")
             return
         
         client.send(filename.encode())
-        msg = client.recv(SIZE).decode()
+        msg = recv_status(client, version)
         
-        exist = client.recv(SIZE).decode()
+        exist = recv_status(client, version)
         print(f"Exists? {exist}")
-        client.send("Downloading".encode())
+        send_status(client, "Downloading", version)
         
         if exist == "Exist":
-            encrypted_data_base64 = receive_large_data(client).decode()
-            encrypted_data = base64.b64decode(encrypted_data_base64)
-
             os.makedirs("Downloaded", exist_ok=True)
-            decrypted_data = decrypt_data(encrypted_data)
-            if isinstance(decrypted_data, bytes):
+            if version >= PROTOCOL_VERSION:
                 try:
-                    decrypted_data = decrypted_data.decode('utf-8')
-                except UnicodeDecodeError:
+                    hash_val, hash2 = receive_file_blocks(client, "Downloaded/"+ filename)
+                except OSError as e:
+                    # The received blocks are kept, reconnect and fetch the rest
+                    client.close()
+                    if attempts > 1:
+                        print(f"Connection lost during download ({e}), resuming...")
+                        time.sleep(RETRY_DELAY)
+                        return download_file(filename, ip, attempts - 1)
+                    raise
+                print(f"Hash value {hash_val}")
+                client.close()
+            else:
+                encrypted_data_base64 = receive_large_data(client).decode()
+                encrypted_data = base64.b64decode(encrypted_data_base64)
+
+                decrypted_data = decrypt_data(encrypted_data)
+                if isinstance(decrypted_data, bytes):
                     try:
-                        decrypted_data = decrypted_data.decode('latin-1')
-                    except:
-                        decrypted_data = decrypted_data.decode('cp1252', errors='ignore')
-            
-            with open("Downloaded/"+ filename, 'w', encoding='utf-8') as f:
-                f.write(decrypted_data)
+                        decrypted_data = decrypted_data.decode('utf-8')
+                    except UnicodeDecodeError:
+                        try:
+                            decrypted_data = decrypted_data.decode('latin-1')
+                        except:
+                            decrypted_data = decrypted_data.decode('cp1252', errors='ignore')
+                
+                with open("Downloaded/"+ filename, 'w', encoding='utf-8') as f:
+                    f.write(decrypted_data)
 
-            hash_val = client.recv(SIZE).decode()
-            print(f"Hash value {hash_val}")
-            client.close()
+                hash_val = client.recv(SIZE).decode()
+                print(f"Hash value {hash_val}")
+                client.close()
 
-            ch = chunk_file("Downloaded/"+ filename, 1024)
-            hash2 = merkle_tree(ch)
+                ch = chunk_file("Downloaded/"+ filename, 1024)
+                hash2 = merkle_tree(ch)
             print(f"Hash value: {hash2}")
 
             if hash2 == hash_val:
@@ -561,6 +746,7 @@ def download_file(filename, ip):
         show_error_message("Download failed due to connection issues.")
         return False
 
+# Send-and-wait exchange used with legacy servers
 def send_large_data(client, data):
     data_length = len(data)
     client.send(str(data_length).encode())
@@ -588,17 +774,31 @@ def receive_large_data(client):
     
     return received_data
 
+# The server's event log, and the indexed copy of it the dashboard queries
+LOG_FILE = os.path.join("..", "server-side", "logs.csv")
+EVENT_DB = "events.db"
+BERT_EVENT = "BERT_Operation"
+
+def load_event_store():
+    """Open the event store with the events logged since the last rerender added"""
+    store = EventStore(EVENT_DB)
+    try:
+        store.ingest(LOG_FILE)
+    except Exception:
+        store.close()
+        raise
+    return store
+
 def get_bert_recovery_stats():
     """Read BERT recovery statistics from server logs"""
     try:
-        log_file = os.path.join("..", "server-side", "logs.csv")
-        if os.path.exists(log_file):
-            df = pd.read_csv(log_file)
-            bert_ops = df[df['Event'] == 'BERT_Operation']
+        if os.path.exists(LOG_FILE):
+            with load_event_store() as store:
+                status_counts = store.status_counts(BERT_EVENT)
             
-            total_bert_ops = len(bert_ops)
-            successful_recoveries = len(bert_ops[bert_ops['Status'] == 'Successful'])
-            failed_recoveries = len(bert_ops[bert_ops['Status'] == 'Failed'])
+            total_bert_ops = sum(status_counts.values())
+            successful_recoveries = status_counts.get('Successful', 0)
+            failed_recoveries = status_counts.get('Failed', 0)
             
             success_rate = f"{(successful_recoveries/total_bert_ops*100):.1f}%" if total_bert_ops > 0 else "0%"
             
@@ -633,23 +833,19 @@ def get_bert_recovery_stats():
 def get_recent_bert_logs():
     """Get recent BERT recovery logs from server"""
     try:
-        log_file = os.path.join("..", "server-side", "logs.csv")
-        if os.path.exists(log_file):
-            df = pd.read_csv(log_file)
-            bert_ops = df[df['Event'] == 'BERT_Operation'].tail(10)
+        if os.path.exists(LOG_FILE):
+            with load_event_store() as store:
+                bert_ops = store.recent(BERT_EVENT, 10)
             
-            if len(bert_ops) > 0:
-                logs = []
-                for _, row in bert_ops.iterrows():
-                    logs.append({
-                        "Timestamp": f"{row['Date']} {row['Timestamp']}",
-                        "File": row['Filename'],
-                        "Status": row['Status'],
-                        "Details": row.get('Details', 'BERT recovery operation')
-                    })
-                return logs
-            else:
-                return []
+            logs = []
+            for row in bert_ops:
+                logs.append({
+                    "Timestamp": f"{row['date']} {row['time']}",
+                    "File": row['filename'],
+                    "Status": row['status'],
+                    "Details": row['details'] or 'BERT recovery operation'
+                })
+            return logs
         else:
             return []
     except Exception as e:
@@ -659,15 +855,12 @@ def get_recent_bert_logs():
 def create_recovery_charts():
     """Create visual charts for BERT recovery statistics"""
     try:
-        log_file = os.path.join("..", "server-side", "logs.csv")
-        if os.path.exists(log_file):
-            df = pd.read_csv(log_file)
-            bert_ops = df[df['Event'] == 'BERT_Operation'].copy()
+        if os.path.exists(LOG_FILE):
+            with load_event_store() as store:
+                status_counts = pd.Series(store.status_counts(BERT_EVENT))
+                daily = pd.DataFrame(store.daily_counts(BERT_EVENT), columns=['Date', 'Status', 'Count'])
             
-            if len(bert_ops) > 0:
-                bert_ops['DateTime'] = pd.to_datetime(bert_ops['Date'] + ' ' + bert_ops['Timestamp'])
-                
-                status_counts = bert_ops['Status'].value_counts()
+            if len(daily) > 0:
                 fig_pie = px.pie(
                     values=status_counts.values, 
                     names=status_counts.index,
@@ -682,11 +875,9 @@ def create_recovery_charts():
                     plot_bgcolor='rgba(0,0,0,0)'
                 )
                 
-                daily_stats = bert_ops.groupby(bert_ops['DateTime'].dt.date).agg({
-                    'Status': lambda x: (x == 'Successful').sum(),
-                    'Filename': 'count'
-                }).reset_index()
-                daily_stats.columns = ['Date', 'Successful', 'Total']
+                # Daily totals come pre-aggregated from the store's rollups
+                daily['Successful'] = daily['Count'].where(daily['Status'] == 'Successful', 0)
+                daily_stats = daily.groupby('Date').agg(Successful=('Successful', 'sum'), Total=('Count', 'sum')).reset_index()
                 daily_stats['Failed'] = daily_stats['Total'] - daily_stats['Successful']
                 
                 fig_trend = go.Figure()
@@ -984,6 +1175,19 @@ if __name__ == "__main__":
                     
                     status_text.text("Upload complete!")
                     st.balloons()
+            
+            # BERT recoveries started by uploads in this session
+            if st.session_state.get('recovery_jobs'):
+                st.markdown("### 🔄 BERT Recovery Jobs")
+                if st.button("🔄 Check Recovery Status", use_container_width=True):
+                    for name, job_id in st.session_state.recovery_jobs.items():
+                        state, details = recovery_status(job_id, ip)
+                        if state == "Recovered":
+                            show_success_message(f"{name}: {details}")
+                        elif state == "Failed":
+                            show_error_message(f"{name}: {details}")
+                        else:
+                            st.info(f"{name}: {state} - {details}")
         
         with tab2:
             st.markdown("### 📥 Download Files from Server")
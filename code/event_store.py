@@ -0,0 +1,240 @@
+'''
+Event Store for the Secure File Transfer Analytics
+Ingests the server's event log incrementally into an indexed SQLite
+database with daily rollups, so the dashboard never rereads the whole log
+'''
+
+import os
+import io
+import csv
+import json
+import sqlite3
+from collections import Counter
+
+# Columns of the rows the server writes (event_log.LOG_FIELDS). Rows may stop
+# early, and older logs begin with a header of their own that these rows
+# were appended under, so the header line alone cannot be trusted.
+DEFAULT_FIELDS = ["Date", "Timestamp", "Client Address", "Event", "Filename", "Status", "Details"]
+# BERT rows carry this marker in the address column and the operation in
+# the event column
+BERT_EVENT = "BERT_Operation"
+# Rotated copies of a log (<log>.1 to <log>.N) looked through for history
+MAX_ROTATED_LOGS = 100
+# Seconds to wait for another process that is ingesting at the same time
+BUSY_TIMEOUT = 30.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    date TEXT,
+    time TEXT,
+    address TEXT,
+    event TEXT,
+    operation TEXT,
+    filename TEXT,
+    status TEXT,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS events_by_event ON events (event, id);
+CREATE INDEX IF NOT EXISTS events_by_date ON events (date);
+CREATE INDEX IF NOT EXISTS events_by_status ON events (event, status);
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    date TEXT,
+    event TEXT,
+    status TEXT,
+    count INTEGER,
+    PRIMARY KEY (date, event, status)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    inode INTEGER,
+    offset INTEGER,
+    header TEXT
+);
+"""
+
+
+class EventStore:
+    """
+    SQLite copy of the server's event log.
+
+    `ingest` reads only what was appended to the log since the last call,
+    following the log across rotations, and adds it to the events table
+    and the per-day counts in daily_rollups in one transaction. Queries
+    are answered from the indexes and rollups.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path: SQLite database file, created if missing
+        """
+        self.db_path = db_path
+        self.db = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def ingest(self, log_path):
+        """
+        Add the events appended to a log (CSV or JSONL) since the last call
+
+        Returns:
+            int: Number of events added
+        """
+        # Hold the write lock for the whole read, so two dashboards ingesting
+        # at once cannot both add the same rows
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            added = self._ingest(os.path.abspath(log_path))
+            self.db.execute("COMMIT")
+            return added
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def _ingest(self, log_path):
+        state = self.db.execute("SELECT inode, offset, header FROM sources WHERE path = ?", (log_path,)).fetchone()
+        try:
+            current_inode = os.stat(log_path).st_ino
+        except FileNotFoundError:
+            return 0
+
+        # The files to read, oldest first: when the log has rotated since the
+        # last call, the rest of the file read last time and every file
+        # rotated after it; on the first call, all rotated history
+        rotated = []
+        for number in range(1, MAX_ROTATED_LOGS + 1):
+            try:
+                rotated.append((f"{log_path}.{number}", os.stat(f"{log_path}.{number}").st_ino))
+            except FileNotFoundError:
+                break
+        files = [(path, inode, 0, None) for path, inode in reversed(rotated)]
+        if state is not None:
+            inode, offset, header = state
+            header = json.loads(header) if header else None
+            previous = [i for i, (_, rotated_inode, _, _) in enumerate(files) if rotated_inode == inode]
+            if inode == current_inode:
+                files = []
+                current = (log_path, current_inode, offset, header)
+            else:
+                files = files[previous[0]:] if previous else []
+                if files:
+                    files[0] = (files[0][0], inode, offset, header)
+                current = (log_path, current_inode, 0, None)
+        else:
+            current = (log_path, current_inode, 0, None)
+
+        added = 0
+        for path, _, offset, header in files:
+            records, _, _ = self._read(path, offset, header)
+            added += self._store(records)
+        records, offset, header = self._read(log_path, current[2], current[3])
+        added += self._store(records)
+
+        self.db.execute("INSERT OR REPLACE INTO sources (path, inode, offset, header) VALUES (?, ?, ?, ?)",
+                        (log_path, current_inode, offset, json.dumps(header) if header else None))
+        return added
+
+    def _read(self, path, offset, header):
+        """
+        Parse the complete lines of a log from `offset` on
+
+        Returns:
+            tuple: (list of event dicts keyed by column name, offset after
+            the last complete line, CSV header)
+        """
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < offset:
+                # Truncated and rewritten in place: start over
+                offset, header = 0, None
+            f.seek(offset)
+            data = f.read()
+        # A batch still being written is left for the next call
+        end = data.rfind(b'\n') + 1
+        text = data[:end].decode('utf-8', errors='replace')
+
+        records = []
+        if path.endswith('.jsonl') or '.jsonl.' in os.path.basename(path):
+            for line in text.splitlines():
+                if line.strip():
+                    records.append(json.loads(line))
+        else:
+            rows = csv.reader(io.StringIO(text))
+            for row in rows:
+                if not row:
+                    continue
+                if header is None:
+                    if row[0] == "Date":
+                        header = row
+                        continue
+                    header = DEFAULT_FIELDS
+                records.append(dict(zip(self._columns(row, header), row)))
+        return records, offset + end, header
+
+    def _columns(self, row, header):
+        """
+        Column names for a CSV row: the server's layout for rows it wrote,
+        which have all its columns or a client address in the third, and
+        the file's own header for anything else
+        """
+        if len(row) == len(DEFAULT_FIELDS) or (len(row) > 2 and row[2].startswith("(")):
+            return DEFAULT_FIELDS
+        if len(row) == len(header):
+            return header
+        return DEFAULT_FIELDS
+
+    def _store(self, records):
+        rows = []
+        rollups = Counter()
+        for record in records:
+            address = record.get("Client Address")
+            event = record.get("Event")
+            operation = None
+            if address == BERT_EVENT:
+                address, event, operation = None, BERT_EVENT, event
+            row = (record.get("Date"), record.get("Timestamp"), address, event, operation,
+                   record.get("Filename"), record.get("Status"), record.get("Details"))
+            rows.append(row)
+            rollups[row[0], event, row[6]] += 1
+
+        self.db.executemany("INSERT INTO events (date, time, address, event, operation, filename, status, details) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.db.executemany("INSERT INTO daily_rollups (date, event, status, count) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT (date, event, status) DO UPDATE SET count = count + excluded.count",
+                            [(date, event, status, count) for (date, event, status), count in rollups.items()])
+        return len(rows)
+
+    def status_counts(self, event):
+        """
+        Returns:
+            dict: {status: number of events} for one kind of event
+        """
+        return dict(self.db.execute("SELECT status, SUM(count) FROM daily_rollups WHERE event = ? GROUP BY status",
+                                    (event,)))
+
+    def daily_counts(self, event):
+        """
+        Returns:
+            list: (date, status, number of events) for one kind of event, by date
+        """
+        return self.db.execute("SELECT date, status, count FROM daily_rollups WHERE event = ? ORDER BY date",
+                               (event,)).fetchall()
+
+    def recent(self, event, limit=10):
+        """
+        Returns:
+            list: The latest `limit` events of one kind as dicts, oldest first
+        """
+        cursor = self.db.execute("SELECT date, time, address, operation, filename, status, details FROM events "
+                                 "WHERE event = ? ORDER BY id DESC LIMIT ?", (event, limit))
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in reversed(cursor.fetchall())]
@@ -4,48 +4,326 @@ Supports text extraction from PDF, DOCX, and other text formats
 '''
 
 import os
+import codecs
+import zipfile
 import logging
+import threading
 from pathlib import Path
+from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# PDFs with at least this many pages are extracted by a pool of processes,
+# each taking a range of pages
+PARALLEL_PAGES = 32
+EXTRACT_WORKERS = os.cpu_count() or 1
+# Extracted PDF/DOCX texts remembered by content hash, least recent dropped first
+EXTRACTION_CACHE_ENTRIES = 32
+HASH_CHUNK_SIZE = 1024 * 1024
+# Characters of a plain text file yielded at a time by iter_text
+TEXT_BLOCK_CHARS = 64 * 1024
+# Bytes read from the start of a file to recognise its format, and detected
+# formats remembered per file, least recent dropped first
+SNIFF_BYTES = 512
+FORMAT_CACHE_ENTRIES = 1024
+
+# PDF extraction processes shared by every FileProcessor, started on first use
+_extract_pool = None
+_extract_pool_lock = threading.Lock()
+
+
+def _get_extract_pool():
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is None:
+            _extract_pool = ProcessPoolExecutor(max_workers=EXTRACT_WORKERS)
+        return _extract_pool
+
+
+def _discard_extract_pool(pool):
+    global _extract_pool
+    with _extract_pool_lock:
+        if _extract_pool is pool:
+            _extract_pool = None
+
+
+def shutdown_extract_pool():
+    """
+    Stop the shared PDF extraction processes, if they were started
+    """
+    global _extract_pool
+    with _extract_pool_lock:
+        pool, _extract_pool = _extract_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+class FileFormat:
+    """
+    A document format FileProcessor can extract text from
+    """
+
+    def __init__(self, name, extensions, reader, iter_text=None, magic=None,
+                 confirm=None, plain_text=False, cached=False):
+        """
+        Args:
+            name: Short name of the format
+            extensions: File extensions (lowercase, with the dot) of the format
+            reader: Callable (processor, file_path) -> extracted text or None
+            iter_text: Optional callable (processor, file_path, block_chars)
+                yielding the text in pieces; without one the reader's text is
+                yielded whole
+            magic: Bytes every file of the format starts with, if any
+            confirm: Optional callable (file_path) -> bool, for magic bytes
+                shared with other formats, telling whether a file that has
+                them really is this format
+            plain_text: Whether the file's bytes are its text, so it can be
+                recovered in place
+            cached: Whether extracted text is worth keeping in the extraction cache
+        """
+        self.name = name
+        self.extensions = tuple(extensions)
+        self.reader = reader
+        self.iter_text = iter_text
+        self.magic = magic
+        self.confirm = confirm
+        self.plain_text = plain_text
+        self.cached = cached
+
+
+# Registered formats by name, and by extension
+FORMATS = {}
+EXTENSION_FORMATS = {}
+
+
+def register_format(file_format):
+    """
+    Make a format available to every FileProcessor, replacing any format
+    of the same name or claiming the same extensions
+    """
+    FORMATS[file_format.name] = file_format
+    for extension in file_format.extensions:
+        EXTENSION_FORMATS[extension] = file_format
+
+
+def sniff_format(extension, head, file_path=None):
+    """
+    Decide the format of a file from its extension and first bytes
+    
+    Content wins over the extension: a file starting with a registered
+    format's magic bytes is that format whatever it is called, once the
+    format's confirm check (given `file_path`) agrees. A file whose
+    extension promises magic bytes it does not have is read as plain text
+    if it looks like text, and is unsupported otherwise.
+    
+    Returns:
+        FileFormat: The format, or None if no extractor can handle the file
+    """
+    for file_format in FORMATS.values():
+        if file_format.magic and head.startswith(file_format.magic):
+            if file_format.confirm is None or (file_path is not None and file_format.confirm(file_path)):
+                return file_format
+    
+    file_format = EXTENSION_FORMATS.get(extension)
+    if file_format is not None and file_format.magic and head:
+        text_format = FORMATS.get('text')
+        return text_format if b'\0' not in head else None
+    return file_format
+
+
+def _iter_pdf_pages(file_path, start=0, stop=None):
+    """
+    Yield the text of pages [start, stop) of a PDF, one page at a time
+
+    Pages are read with pdfplumber, falling back to PyPDF2 for a page
+    pdfplumber fails on, or for the whole range if pdfplumber is missing or
+    cannot open the file. Pages without text yield an empty string.
+    """
+    fallback = None
+
+    def pypdf2_page(number):
+        nonlocal fallback
+        if fallback is None:
+            import PyPDF2
+            fallback = PyPDF2.PdfReader(file_path)
+        return fallback.pages[number].extract_text() or ""
+
+    try:
+        import pdfplumber
+        pdf = pdfplumber.open(file_path)
+    except Exception as e:
+        logger.warning(f"pdfplumber cannot read {file_path} ({e}), trying PyPDF2")
+        for number in range(start, _pdf_page_count(file_path) if stop is None else stop):
+            yield pypdf2_page(number)
+        return
+
+    with pdf:
+        for number in range(start, len(pdf.pages) if stop is None else stop):
+            page = pdf.pages[number]
+            try:
+                yield page.extract_text() or ""
+            except Exception as e:
+                logger.warning(f"pdfplumber failed on page {number + 1}: {e}, trying PyPDF2")
+                yield pypdf2_page(number)
+            # Drop the parsed layout so memory does not grow with the page count
+            page.flush_cache()
+
+
+def _extract_pdf_pages(file_path, start, stop):
+    """
+    Worker job: the texts of pages [start, stop) of a PDF
+    """
+    return list(_iter_pdf_pages(file_path, start, stop))
+
+
+def _is_docx(file_path):
+    """
+    Tell a DOCX from other ZIP files (.zip, .xlsx, .pptx, ...), which share
+    its magic bytes, by its main document part
+    """
+    try:
+        with zipfile.ZipFile(file_path) as archive:
+            archive.getinfo('word/document.xml')
+        return True
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return False
+
+
+def _docx_parts(file_path):
+    """
+    Yield the non-blank paragraph texts of a DOCX file, then its table cells
+    """
+    import docx
+
+    doc = docx.Document(file_path)
+    for paragraph in doc.paragraphs:
+        if paragraph.text.strip():
+            yield paragraph.text
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                if cell.text.strip():
+                    yield cell.text
+
+
+def _join_parts(parts):
+    """
+    Incremental "\\n".join(non-empty parts).strip(): yields pieces that
+    concatenate to it, holding back trailing whitespace until more text follows
+    """
+    pending = None
+    for part in parts:
+        if not part:
+            continue
+        if pending is None:
+            part = part.lstrip()
+            if not part:
+                continue
+        else:
+            part = pending + "\n" + part
+        body = part.rstrip()
+        pending = part[len(body):]
+        if body:
+            yield body
+
+
+def _pdf_page_count(file_path):
+    try:
+        import pdfplumber
+        with pdfplumber.open(file_path) as pdf:
+            return len(pdf.pages)
+    except Exception:
+        import PyPDF2
+        return len(PyPDF2.PdfReader(file_path).pages)
+
+
 class FileProcessor:
     """
     Enhanced file processor for multiple document formats
     """
     
-    def __init__(self):
-        self.supported_extensions = {
-            # Text formats
-            '.txt': self._read_text_file,
-            '.md': self._read_text_file,
-            '.py': self._read_text_file,
-            '.js': self._read_text_file,
-            '.html': self._read_text_file,
-            '.css': self._read_text_file,
-            '.json': self._read_text_file,
-            '.xml': self._read_text_file,
-            '.csv': self._read_text_file,
-            # Document formats
-            '.pdf': self._read_pdf_file,
-            '.docx': self._read_docx_file,
-            '.doc': self._read_docx_file,  # Will try to convert
-        }
+    def __init__(self, workers=EXTRACT_WORKERS, cache_entries=EXTRACTION_CACHE_ENTRIES):
+        """
+        Args:
+            workers: Page ranges' worth of parallelism large PDFs are split
+                for; the ranges run on the shared pool of EXTRACT_WORKERS
+                processes
+            cache_entries: Extracted documents kept in the cache (0 disables it)
+        """
+        self.workers = workers
+        self.cache_entries = cache_entries
+        self._cache = OrderedDict()
+        self._formats = OrderedDict()
+        # Server connections detect formats from their own threads
+        self._formats_lock = threading.Lock()
+    
+    def detect_format(self, file_path):
+        """
+        Find the format of a file by its extension and magic bytes
+        
+        The result is remembered per file identity (device, inode, size and
+        modification time), so repeated checks on a file cost one stat. A
+        file that does not exist is judged by its extension alone.
+        
+        Returns:
+            FileFormat: The format, or None if unsupported
+        """
+        return self._detect(file_path)[1]
+    
+    def _detect(self, file_path):
+        """
+        Returns:
+            tuple: (os.stat_result or None if the file is missing, FileFormat or None)
+        """
+        extension = os.path.splitext(file_path)[1].lower()
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None, EXTENSION_FORMATS.get(extension)
+        
+        key = (extension, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self._formats_lock:
+            if key in self._formats:
+                self._formats.move_to_end(key)
+                return stat, self._formats[key]
+        
+        try:
+            with open(file_path, 'rb') as f:
+                head = f.read(SNIFF_BYTES)
+        except OSError:
+            return stat, EXTENSION_FORMATS.get(extension)
+        
+        file_format = sniff_format(extension, head, file_path)
+        with self._formats_lock:
+            self._formats[key] = file_format
+            if len(self._formats) > FORMAT_CACHE_ENTRIES:
+                self._formats.popitem(last=False)
+        return stat, file_format
     
     def is_supported_format(self, file_path):
         """
         Check if file format is supported for text extraction
         """
-        _, ext = os.path.splitext(file_path.lower())
-        return ext in self.supported_extensions
+        return self.detect_format(file_path) is not None
+    
+    def is_plain_text(self, file_path):
+        """
+        Check if a file is stored as plain text, so its bytes can be
+        recovered in place rather than through text extraction
+        """
+        file_format = self.detect_format(file_path)
+        return file_format is not None and file_format.plain_text
     
     def get_supported_formats(self):
         """
         Get list of supported file formats
         """
-        return list(self.supported_extensions.keys())
+        return list(EXTENSION_FORMATS)
     
     def extract_text(self, file_path):
         """
@@ -58,18 +336,29 @@ class FileProcessor:
             str: Extracted text content, or None if failed
         """
         try:
-            if not os.path.exists(file_path):
+            stat, file_format = self._detect(file_path)
+            if stat is None:
                 logger.error(f"File not found: {file_path}")
                 return None
             
-            _, ext = os.path.splitext(file_path.lower())
-            
-            if ext not in self.supported_extensions:
-                logger.warning(f"Unsupported file format: {ext}")
+            if file_format is None:
+                logger.warning(f"Unsupported file format: {os.path.splitext(file_path)[1].lower()}")
                 return None
             
+            # Documents already extracted are served from the cache by content hash
+            cache_key = None
+            if file_format.cached and self.cache_entries:
+                cache_key = self._content_hash(file_path)
+                if cache_key in self._cache:
+                    self._cache.move_to_end(cache_key)
+                    logger.info(f"✅ Using cached text for {file_path}")
+                    return self._cache[cache_key]
+            
             # Extract text using appropriate method
-            text = self.supported_extensions[ext](file_path)
+            text = file_format.reader(self, file_path)
+            
+            if text and cache_key is not None:
+                self._remember(cache_key, text)
             
             if text:
                 logger.info(f"✅ Successfully extracted text from {file_path}")
@@ -83,6 +372,88 @@ class FileProcessor:
             logger.error(f"Error extracting text from {file_path}: {e}")
             return None
     
+    def iter_text(self, file_path, block_chars=TEXT_BLOCK_CHARS):
+        """
+        Extract text from a file a piece at a time, so a large document
+        never has to be held in memory whole
+        
+        Plain text files are read in blocks of `block_chars`, PDFs a page
+        at a time and DOCX files a paragraph at a time. The pieces join to
+        the text `extract_text` returns. PDFs and DOCX files share
+        `extract_text`'s cache: a cached document is yielded in one piece,
+        and one read to the end is added to the cache.
+        
+        Args:
+            file_path: Path to the file
+            block_chars: Characters per piece for plain text files
+        
+        Yields:
+            tuple: (character offset of the piece in the extracted text, piece)
+        """
+        stat, file_format = self._detect(file_path)
+        if stat is None:
+            logger.error(f"File not found: {file_path}")
+            return
+        
+        if file_format is None:
+            logger.warning(f"Unsupported file format: {os.path.splitext(file_path)[1].lower()}")
+            return
+        
+        cache_key = None
+        if file_format.cached and self.cache_entries:
+            cache_key = self._content_hash(file_path)
+            if cache_key in self._cache:
+                self._cache.move_to_end(cache_key)
+                yield 0, self._cache[cache_key]
+                return
+        
+        offset = 0
+        # Pieces of a document that goes in the cache, kept until it is read whole
+        read = [] if cache_key is not None else None
+        try:
+            if file_format.iter_text is not None:
+                pieces = file_format.iter_text(self, file_path, block_chars)
+            else:
+                text = file_format.reader(self, file_path)
+                pieces = [text] if text else []
+            for piece in pieces:
+                if read is not None:
+                    read.append(piece)
+                yield offset, piece
+                offset += len(piece)
+        except Exception as e:
+            logger.error(f"Error extracting text from {file_path} at character {offset}: {e}")
+            return
+        
+        if read:
+            self._remember(cache_key, "".join(read))
+    
+    def _remember(self, cache_key, text):
+        """
+        Add an extracted document to the cache, dropping the least recent
+        """
+        self._cache[cache_key] = text
+        if len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+    
+    def _iter_text_file(self, file_path, block_chars):
+        """
+        Read a plain text file in blocks, in the encoding `_read_text_file`
+        would pick: UTF-8 if the whole file decodes as UTF-8, else Latin-1
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        encoding = 'utf-8'
+        try:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            encoding = 'latin-1'
+        
+        with open(file_path, 'r', encoding=encoding) as f:
+            yield from iter(lambda: f.read(block_chars), '')
+    
     def _read_text_file(self, file_path):
         """
         Read text from plain text files
@@ -106,51 +477,59 @@ class FileProcessor:
             logger.error(f"Error reading text file {file_path}: {e}")
             return None
     
+    def _content_hash(self, file_path):
+        """
+        SHA-256 of a file's content, the key of the extraction cache
+        """
+        digest = sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def _pdf_pages(self, file_path):
+        """
+        Yield the texts of a PDF's pages in order
+        
+        Pages are read one at a time with pdfplumber, falling back to
+        PyPDF2 for pages it cannot handle. Large PDFs are split into page
+        ranges extracted in parallel, yielded in order as they finish.
+        """
+        page_count = _pdf_page_count(file_path)
+        workers = min(self.workers, page_count // PARALLEL_PAGES)
+        if workers <= 1:
+            yield from _iter_pdf_pages(file_path, 0, page_count)
+            return
+        
+        # A few ranges per worker so one slow range does not hold up the rest
+        step = -(-page_count // (workers * 4))
+        starts = range(0, page_count, step)
+        stops = [min(start + step, page_count) for start in starts]
+        pool = _get_extract_pool()
+        try:
+            for part in pool.map(_extract_pdf_pages, [file_path] * len(starts), starts, stops):
+                yield from part
+        except BrokenProcessPool:
+            # A worker died: the next caller starts a fresh pool
+            _discard_extract_pool(pool)
+            raise
+    
     def _read_pdf_file(self, file_path):
         """
         Extract text from PDF files using multiple methods
         """
         try:
-            # Method 1: Try pdfplumber (better for complex PDFs)
-            try:
-                import pdfplumber
-                with pdfplumber.open(file_path) as pdf:
-                    text = ""
-                    for page in pdf.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                    
-                    if text.strip():
-                        logger.info(f"✅ Extracted text using pdfplumber: {len(text)} characters")
-                        return text.strip()
-            except ImportError:
-                logger.warning("pdfplumber not available, trying PyPDF2")
-            except Exception as e:
-                logger.warning(f"pdfplumber failed: {e}, trying PyPDF2")
-            
-            # Method 2: Try PyPDF2 (fallback)
-            try:
-                import PyPDF2
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    text = ""
-                    for page in pdf_reader.pages:
-                        page_text = page.extract_text()
-                        if page_text:
-                            text += page_text + "\n"
-                    
-                    if text.strip():
-                        logger.info(f"✅ Extracted text using PyPDF2: {len(text)} characters")
-                        return text.strip()
-            except ImportError:
-                logger.error("PyPDF2 not available for PDF processing")
-            except Exception as e:
-                logger.error(f"PyPDF2 failed: {e}")
+            text = "".join(_join_parts(self._pdf_pages(file_path)))
+            if text:
+                logger.info(f"✅ Extracted text from PDF: {len(text)} characters")
+                return text
             
             logger.error(f"❌ Failed to extract text from PDF: {file_path}")
             return None
             
+        except ImportError:
+            logger.error("Neither pdfplumber nor PyPDF2 is available for PDF processing")
+            return None
         except Exception as e:
             logger.error(f"Error processing PDF {file_path}: {e}")
             return None
@@ -160,26 +539,10 @@ class FileProcessor:
         Extract text from DOCX files
         """
         try:
-            import docx
-            
-            doc = docx.Document(file_path)
-            text = ""
-            
-            # Extract text from paragraphs
-            for paragraph in doc.paragraphs:
-                if paragraph.text.strip():
-                    text += paragraph.text + "\n"
-            
-            # Extract text from tables
-            for table in doc.tables:
-                for row in table.rows:
-                    for cell in row.cells:
-                        if cell.text.strip():
-                            text += cell.text + "\n"
-            
-            if text.strip():
+            text = "".join(_join_parts(_docx_parts(file_path)))
+            if text:
                 logger.info(f"✅ Extracted text from DOCX: {len(text)} characters")
-                return text.strip()
+                return text
             else:
                 logger.warning(f"❌ No text found in DOCX file: {file_path}")
                 return None
@@ -219,18 +582,17 @@ class FileProcessor:
             dict: File information
         """
         try:
-            if not os.path.exists(file_path):
+            stat, file_format = self._detect(file_path)
+            if stat is None:
                 return None
             
-            stat = os.stat(file_path)
-            _, ext = os.path.splitext(file_path.lower())
-            
             info = {
                 'path': file_path,
                 'name': os.path.basename(file_path),
-                'extension': ext,
+                'extension': os.path.splitext(file_path)[1].lower(),
+                'format': file_format.name if file_format else None,
                 'size': stat.st_size,
-                'is_supported': self.is_supported_format(file_path),
+                'is_supported': file_format is not None,
                 'supported_formats': self.get_supported_formats()
             }
             
@@ -240,6 +602,18 @@ class FileProcessor:
             logger.error(f"Error getting file info for {file_path}: {e}")
             return None
 
+# Built-in formats
+register_format(FileFormat('text', ('.txt', '.md', '.py', '.js', '.html', '.css', '.json', '.xml', '.csv'),
+                           FileProcessor._read_text_file, FileProcessor._iter_text_file, plain_text=True))
+register_format(FileFormat('pdf', ('.pdf',), FileProcessor._read_pdf_file,
+                           lambda processor, file_path, block_chars: _join_parts(processor._pdf_pages(file_path)),
+                           magic=b'%PDF-', cached=True))
+# .doc is tried as DOCX; real Word 97 files fail their magic check and are rejected
+register_format(FileFormat('docx', ('.docx', '.doc'), FileProcessor._read_docx_file,
+                           lambda processor, file_path, block_chars: _join_parts(_docx_parts(file_path)),
+                           magic=b'PK\x03\x04', confirm=_is_docx, cached=True))
+
+
 def main():
     """
     Test the file processor
@@ -0,0 +1,125 @@
+'''
+Inference Backends for BERT File Recovery
+Runs the masked language model as plain fp32 PyTorch, as a dynamically
+int8-quantized PyTorch model, or through ONNX Runtime
+'''
+
+import os
+import re
+import copy
+import tempfile
+import torch
+
+# Where exported ONNX models are kept between runs
+ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_models")
+ONNX_OPSET = 14
+
+
+class TorchBackend:
+    """
+    The model as loaded, in fp32 on the recovery device
+    """
+
+    name = 'torch'
+
+    def __init__(self, model, device, model_name):
+        self.model = model
+        self.device = device
+
+    def logits(self, input_ids, attention_mask):
+        """
+        Run a padded batch through the model
+
+        Returns:
+            torch.Tensor: Logits of shape (batch, sequence, vocabulary) on the CPU
+                or recovery device
+        """
+        with torch.no_grad():
+            return self.model(input_ids=input_ids.to(self.device),
+                              attention_mask=attention_mask.to(self.device)).logits
+
+
+class QuantizedBackend(TorchBackend):
+    """
+    The model with its linear layers dynamically quantized to int8. Weights
+    take a quarter of the memory and matrix products run in int8 on the
+    CPU, which is where BERT spends nearly all its time.
+    """
+
+    name = 'quantized'
+
+    def __init__(self, model, device, model_name):
+        # Quantized kernels are CPU only; copy rather than move so the fp32
+        # model stays usable on its device if this backend is rejected
+        if device.type != 'cpu':
+            model = copy.deepcopy(model).to('cpu')
+        quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        super().__init__(quantized.eval(), torch.device('cpu'), model_name)
+
+
+class _LogitsOnly(torch.nn.Module):
+    # Export wrapper so the ONNX graph has a single logits output
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+
+class OnnxBackend:
+    """
+    The model exported to ONNX (once, then reused from ONNX_DIR) and run
+    with ONNX Runtime on the CPU. Needs the optional onnxruntime package.
+    """
+
+    name = 'onnx'
+
+    def __init__(self, model, device, model_name):
+        import onnxruntime
+
+        os.makedirs(ONNX_DIR, exist_ok=True)
+        path = os.path.join(ONNX_DIR, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name) + ".onnx")
+        if not os.path.exists(path):
+            print(f"Exporting {model_name} to ONNX: {path}")
+            sample = torch.ones((1, 8), dtype=torch.long, device=device)
+            # A file of its own, so recovery workers exporting at the same
+            # time never write into each other's export
+            fd, temp_path = tempfile.mkstemp(dir=ONNX_DIR, suffix=".tmp")
+            os.close(fd)
+            try:
+                torch.onnx.export(_LogitsOnly(model).eval(), (sample, sample), temp_path,
+                                  input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                                  dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                                'attention_mask': {0: 'batch', 1: 'sequence'},
+                                                'logits': {0: 'batch', 1: 'sequence'}},
+                                  opset_version=ONNX_OPSET)
+                os.replace(temp_path, path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+
+    def logits(self, input_ids, attention_mask):
+        (logits,) = self.session.run(['logits'], {'input_ids': input_ids.cpu().numpy(),
+                                                  'attention_mask': attention_mask.cpu().numpy()})
+        return torch.from_numpy(logits)
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    QuantizedBackend.name: QuantizedBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+
+def create_backend(name, model, device, model_name):
+    """
+    Build the inference backend called `name` around a loaded model
+    """
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown inference backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return backend_class(model, device, model_name)
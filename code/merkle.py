@@ -0,0 +1,325 @@
+'''
+Merkle Tree Engine for the Secure File Transfer System
+Iterative, bytes-native tree over raw SHA-256 leaf digests with all
+levels kept in one contiguous buffer
+'''
+
+import os
+import threading
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Size of a Merkle leaf in bytes
+LEAF_SIZE = 1024
+# Size of a raw SHA-256 digest
+DIGEST_SIZE = 32
+# Bytes read at a time when hashing a file from disk
+READ_SIZE = 1024 * 1024
+
+# Files at least this large are hashed in parallel by HASH_WORKERS
+# processes, each building the subtree of one region of the file.
+# Processes rather than threads: hashlib only releases the GIL for
+# buffers of 2 KB or more, and leaves are 1 KB.
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+HASH_WORKERS = os.cpu_count() or 1
+# Smallest region handed to a worker, in leaves
+MIN_REGION_LEAVES = 4096
+
+# Hashing processes shared by every parallel hash, started on first use so
+# concurrent uploads never run more than HASH_WORKERS of them between them
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+
+
+def _get_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            _hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return _hash_pool
+
+
+def _discard_hash_pool(pool):
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is pool:
+            _hash_pool = None
+
+
+def shutdown_hash_pool():
+    """
+    Stop the shared hashing processes, if they were started. Hashing a large
+    file afterwards starts them again.
+    """
+    global _hash_pool
+    with _hash_pool_lock:
+        pool, _hash_pool = _hash_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+class LeafHasher:
+    """
+    Splits a byte stream into fixed-size leaves and hashes each leaf as
+    soon as it is complete, so the stream never has to be held in memory
+    """
+
+    def __init__(self, leaf_size=LEAF_SIZE):
+        self.leaf_size = leaf_size
+        self.leaf_digests = bytearray()
+        self._pending = bytearray()
+
+    def update(self, data):
+        """
+        Feed the next piece of the stream
+        """
+        view = memoryview(data)
+        offset = 0
+        if self._pending:
+            take = min(self.leaf_size - len(self._pending), len(view))
+            self._pending += view[:take]
+            offset = take
+            if len(self._pending) < self.leaf_size:
+                return
+            self.leaf_digests += sha256(self._pending).digest()
+            self._pending.clear()
+
+        end = offset + (len(view) - offset) // self.leaf_size * self.leaf_size
+        for start in range(offset, end, self.leaf_size):
+            self.leaf_digests += sha256(view[start:start + self.leaf_size]).digest()
+        self._pending += view[end:]
+
+    def finish(self):
+        """
+        Hash the trailing partial leaf and return the concatenated leaf digests
+        """
+        if self._pending:
+            self.leaf_digests += sha256(self._pending).digest()
+            self._pending.clear()
+        return self.leaf_digests
+
+
+class MerkleTree:
+    """
+    Binary Merkle tree built bottom-up over raw leaf digests.
+
+    Level 0 holds the leaves and the last level holds the root. Each parent
+    is sha256(left + right) over the raw 32-byte digests; an unpaired node
+    at the end of a level is promoted to the next level unchanged. All
+    levels live back to back in a single bytearray.
+    """
+
+    def __init__(self, leaf_digests):
+        """
+        Args:
+            leaf_digests: Concatenated raw leaf digests (bytes-like)
+        """
+        leaf_digests = memoryview(leaf_digests).cast('B')
+        if len(leaf_digests) % DIGEST_SIZE:
+            raise ValueError("Leaf digests must be a multiple of 32 bytes")
+
+        self._allocate(len(leaf_digests) // DIGEST_SIZE)
+        self._nodes[:len(leaf_digests)] = leaf_digests
+        self._build()
+
+    def _allocate(self, leaf_count):
+        counts = [leaf_count]
+        while counts[-1] > 1:
+            counts.append((counts[-1] + 1) // 2)
+
+        self._counts = counts
+        self._offsets = []
+        total = 0
+        for count in counts:
+            self._offsets.append(total)
+            total += count * DIGEST_SIZE
+        self._nodes = bytearray(total)
+
+    @classmethod
+    def from_nodes(cls, leaf_count, nodes):
+        """
+        Rebuild a tree from the buffer returned by nodes(), without hashing
+        """
+        tree = cls.__new__(cls)
+        tree._allocate(leaf_count)
+        if len(nodes) != len(tree._nodes):
+            raise ValueError(f"Expected {len(tree._nodes)} bytes of nodes for {leaf_count} leaves")
+        tree._nodes[:] = nodes
+        return tree
+
+    @classmethod
+    def from_bytes(cls, data, leaf_size=LEAF_SIZE):
+        """
+        Build a tree over an in-memory byte string
+        """
+        hasher = LeafHasher(leaf_size)
+        hasher.update(data)
+        return cls(hasher.finish())
+
+    @classmethod
+    def from_file(cls, file_path, leaf_size=LEAF_SIZE, workers=None):
+        """
+        Build a tree over a file on disk, reading it in large blocks.
+        Files of PARALLEL_THRESHOLD bytes or more are hashed in parallel.
+
+        Args:
+            file_path: File to hash
+            leaf_size: Size of a leaf in bytes
+            workers: Number of regions' worth of parallelism to split the
+                file for, HASH_WORKERS if None. 1 always hashes serially.
+                The regions are hashed by the shared pool of HASH_WORKERS
+                processes.
+        """
+        workers = HASH_WORKERS if workers is None else workers
+        file_size = os.path.getsize(file_path)
+        if workers > 1 and file_size >= PARALLEL_THRESHOLD:
+            return cls._from_file_parallel(file_path, file_size, leaf_size, workers)
+        return cls(_hash_region(file_path, 0, file_size, leaf_size, 0)[0])
+
+    @classmethod
+    def _from_file_parallel(cls, file_path, file_size, leaf_size, workers):
+        # Regions hold a power-of-two number of leaves, so every region's
+        # subtree up to `height` is exactly the matching part of the full
+        # tree (the last region's unpaired nodes are the level's last nodes)
+        leaf_count = (file_size + leaf_size - 1) // leaf_size
+        region_leaves = MIN_REGION_LEAVES
+        while region_leaves * workers * 4 < leaf_count:
+            region_leaves *= 2
+        height = region_leaves.bit_length() - 1
+        region_size = region_leaves * leaf_size
+
+        offsets = range(0, file_size, region_size)
+        pool = _get_hash_pool()
+        try:
+            subtrees = list(pool.map(_hash_region, [file_path] * len(offsets), offsets,
+                                     [region_size] * len(offsets), [leaf_size] * len(offsets),
+                                     [height] * len(offsets)))
+        except BrokenProcessPool:
+            # A worker died: the next caller starts a fresh pool
+            _discard_hash_pool(pool)
+            raise
+
+        tree = cls.__new__(cls)
+        tree._allocate(leaf_count)
+        for level in range(height + 1):
+            if level < tree.level_count:
+                tree.level(level)[:] = b''.join(subtree[level] for subtree in subtrees)
+        tree._build(height + 1)
+        return tree
+
+    def _build(self, first_level=1):
+        nodes = memoryview(self._nodes)
+        for level in range(first_level, len(self._counts)):
+            src = self._offsets[level - 1]
+            dst = self._offsets[level]
+            child_count = self._counts[level - 1]
+            for pair in range(child_count // 2):
+                start = src + pair * 2 * DIGEST_SIZE
+                end = dst + (pair + 1) * DIGEST_SIZE
+                nodes[end - DIGEST_SIZE:end] = sha256(nodes[start:start + 2 * DIGEST_SIZE]).digest()
+            if child_count % 2:
+                last = src + (child_count - 1) * DIGEST_SIZE
+                end = dst + self._counts[level] * DIGEST_SIZE
+                nodes[end - DIGEST_SIZE:end] = nodes[last:last + DIGEST_SIZE]
+
+    @property
+    def leaf_count(self):
+        return self._counts[0]
+
+    @property
+    def level_count(self):
+        return len(self._counts)
+
+    @property
+    def root(self):
+        """
+        Raw root digest. An empty tree has the digest of empty input.
+        """
+        if self.leaf_count == 0:
+            return sha256(b'').digest()
+        return self.node(self.level_count - 1, 0)
+
+    @property
+    def root_hex(self):
+        return self.root.hex()
+
+    def level_size(self, level):
+        """
+        Number of nodes on a level
+        """
+        return self._counts[level]
+
+    def node(self, level, index):
+        """
+        Raw digest of the node at `index` on `level` (0 = leaves)
+        """
+        if not 0 <= index < self._counts[level]:
+            raise IndexError(f"Node {index} out of range for level {level}")
+        start = self._offsets[level] + index * DIGEST_SIZE
+        return bytes(self._nodes[start:start + DIGEST_SIZE])
+
+    def leaf(self, index):
+        return self.node(0, index)
+
+    def update_leaf(self, index, digest):
+        """
+        Replace a leaf digest and rehash its path up to the root
+        """
+        nodes = memoryview(self._nodes)
+        for level in range(self.level_count):
+            start = self._offsets[level] + index * DIGEST_SIZE
+            nodes[start:start + DIGEST_SIZE] = digest
+            if level + 1 == self.level_count:
+                break
+            left = index & ~1
+            if left + 1 < self._counts[level]:
+                start = self._offsets[level] + left * DIGEST_SIZE
+                digest = sha256(nodes[start:start + 2 * DIGEST_SIZE]).digest()
+            index //= 2
+
+    def level(self, level):
+        """
+        Zero-copy view of all digests on a level, concatenated
+        """
+        start = self._offsets[level]
+        return memoryview(self._nodes)[start:start + self._counts[level] * DIGEST_SIZE]
+
+    def nodes(self):
+        """
+        Zero-copy view of every level back to back, for storing the tree
+        """
+        return memoryview(self._nodes)
+
+    def iter_levels(self):
+        """
+        Yield (level, digests view) pairs from the leaves up to the root
+        """
+        for level in range(self.level_count):
+            yield level, self.level(level)
+
+
+def _hash_region(file_path, offset, length, leaf_size, height):
+    """
+    Hash `length` bytes of a file starting at `offset`, which must be on a
+    leaf boundary. Runs in a worker process for parallel hashing.
+
+    Returns:
+        list: Concatenated digests of levels 0..height of the region's subtree
+    """
+    hasher = LeafHasher(leaf_size)
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            block = f.read(min(READ_SIZE, length))
+            if not block:
+                break
+            hasher.update(block)
+            length -= len(block)
+    leaves = hasher.finish()
+    if height == 0:
+        return [leaves]
+
+    subtree = MerkleTree(leaves)
+    top = subtree.level_count - 1
+    return [bytes(subtree.level(min(level, top))) for level in range(height + 1)]
@@ -0,0 +1,125 @@
+'''
+Merkle Repair Exchange for the Secure File Transfer System
+Locates mismatching leaves by comparing subtree hashes with the peer
+top-down, then retransmits only those leaves
+'''
+
+import struct
+
+from merkle import DIGEST_SIZE
+from transfer_protocol import MAX_FRAME_SIZE, ProtocolError, send_frame, recv_frame, send_frames, recv_frames
+
+# Repair frame types, continuing the numbering in transfer_protocol
+MSG_NODE_REQUEST = 5   # payload: level + node indices
+MSG_NODE_REPLY = 6     # payload: concatenated raw digests, in request order
+MSG_LEAF_REQUEST = 7   # payload: level (always 0) + leaf indices
+MSG_REPAIR_DONE = 8    # empty payload, ends the repair phase
+
+LEVEL = struct.Struct('!B')
+INDEX = struct.Struct('!I')
+
+
+def _pack_indices(level, indices):
+    return LEVEL.pack(level) + struct.pack(f'!{len(indices)}I', *indices)
+
+
+def _unpack_indices(payload):
+    (level,) = LEVEL.unpack_from(payload)
+    count = (len(payload) - LEVEL.size) // INDEX.size
+    return level, struct.unpack_from(f'!{count}I', payload, LEVEL.size)
+
+
+def request_nodes(sock, level, indices):
+    """
+    Ask the peer for the digests of several nodes on one level
+
+    Returns:
+        list: Raw digests in the same order as `indices`
+    """
+    send_frame(sock, MSG_NODE_REQUEST, 0, _pack_indices(level, indices))
+    # The reply may be larger than other frames, but never larger than asked for
+    msg_type, _, payload = recv_frame(sock, max(MAX_FRAME_SIZE, len(indices) * DIGEST_SIZE))
+    if msg_type != MSG_NODE_REPLY or len(payload) != len(indices) * DIGEST_SIZE:
+        raise ProtocolError(f"Bad node reply (type {msg_type}, {len(payload)} bytes)")
+    return [payload[i:i + DIGEST_SIZE] for i in range(0, len(payload), DIGEST_SIZE)]
+
+
+def find_mismatched_leaves(sock, tree, expected_root):
+    """
+    Walk the tree top-down with the peer, descending only into subtrees
+    whose hashes differ. Costs one request per level and O(k log n) digests
+    for k damaged leaves. Both trees must have the same number of leaves.
+
+    Args:
+        sock: Connected socket, the peer is running serve_repair_requests
+        tree: Local MerkleTree of the received data
+        expected_root: Raw root digest advertised by the peer
+
+    Returns:
+        dict: {leaf index: expected raw leaf digest} for every leaf that differs
+    """
+    if tree.leaf_count == 0:
+        return {}
+
+    mismatched = {0: expected_root} if tree.root != expected_root else {}
+    for level in range(tree.level_count - 2, -1, -1):
+        if not mismatched:
+            break
+        size = tree.level_size(level)
+        children = []
+        for index in mismatched:
+            children.append(2 * index)
+            if 2 * index + 1 < size:
+                children.append(2 * index + 1)
+
+        digests = request_nodes(sock, level, children)
+        mismatched = {index: digest for index, digest in zip(children, digests)
+                      if tree.node(level, index) != digest}
+    return mismatched
+
+
+def request_leaves(sock, indices):
+    """
+    Ask the peer to retransmit leaves
+
+    Returns:
+        generator: One payload per requested leaf, in request order. It must
+        be consumed to the end.
+    """
+    send_frame(sock, MSG_LEAF_REQUEST, 0, _pack_indices(0, indices))
+    total, payloads = recv_frames(sock)
+    if total != len(indices):
+        raise ProtocolError(f"Peer is sending {total} leaves, requested {len(indices)}")
+    return payloads
+
+
+def finish_repair(sock):
+    """
+    Tell the peer the repair phase is over
+    """
+    send_frame(sock, MSG_REPAIR_DONE, 0)
+
+
+def serve_repair_requests(sock, tree, read_leaf, encrypt):
+    """
+    Answer node and leaf requests from the verifying peer until it sends
+    MSG_REPAIR_DONE
+
+    Args:
+        sock: Connected socket
+        tree: MerkleTree of the original data
+        read_leaf: Callable returning the plaintext bytes of a leaf by index
+        encrypt: Callable encrypting a leaf before it is sent
+    """
+    while True:
+        msg_type, _, payload = recv_frame(sock)
+        if msg_type == MSG_REPAIR_DONE:
+            return
+        if msg_type == MSG_NODE_REQUEST:
+            level, indices = _unpack_indices(payload)
+            send_frame(sock, MSG_NODE_REPLY, 0, b''.join(tree.node(level, i) for i in indices))
+        elif msg_type == MSG_LEAF_REQUEST:
+            _, indices = _unpack_indices(payload)
+            send_frames(sock, (encrypt(read_leaf(i)) for i in indices), len(indices))
+        else:
+            raise ProtocolError(f"Unexpected frame type {msg_type} during repair")
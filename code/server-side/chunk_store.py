@@ -0,0 +1,188 @@
+'''
+Content-Addressed Chunk Store for the Secure File Transfer Server
+Finds every distinct upload chunk by its SHA-256 digest, so re-uploads of
+revised files only transfer the chunks that changed
+'''
+
+import os
+import time
+import struct
+import tempfile
+import threading
+from hashlib import sha256
+
+# Manifest layout: length of the file name, the UTF-8 name, then the
+# length and digest of each chunk of the file in order
+MANIFEST_NAME = struct.Struct('!H')
+MANIFEST_ENTRY = struct.Struct('!I32s')
+
+
+class ChunkStore:
+    """
+    Chunks of uploads in progress live in `<root>/<first two hex
+    digits>/<hex digest>`. Once an upload is assembled into `files_dir`,
+    its manifest records where each chunk sits in the stored file and the
+    separate copies are deleted: a stored file's chunks are read back out
+    of the file itself, so they take no extra disk space.
+
+    A stored file changed without a new manifest (legacy uploads, BERT
+    recovery) may no longer hold a chunk its manifest lists. Chunks read
+    from files are checked against their digest, and such a chunk is
+    reported missing by `get` although `has` said it was there; the upload
+    then leaves it to the Merkle repair.
+    """
+
+    def __init__(self, root_dir, files_dir):
+        """
+        Args:
+            root_dir: Directory of the chunk copies and manifests
+            files_dir: Directory the files named in manifests are stored in
+        """
+        self.root_dir = root_dir
+        self.files_dir = files_dir
+        self.manifest_dir = os.path.join(root_dir, "manifests")
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        # {digest: (file name, offset, length)} for the chunks of stored files
+        self._locations = {}
+        for name in os.listdir(self.manifest_dir):
+            if not name.endswith(".tmp"):
+                self._index(*self._read_manifest(os.path.join(self.manifest_dir, name)))
+
+    def path(self, digest):
+        name = digest.hex()
+        return os.path.join(self.root_dir, name[:2], name)
+
+    def has(self, digest):
+        return digest in self._locations or os.path.exists(self.path(digest))
+
+    def get(self, digest):
+        """
+        Read a chunk, or return None if the store does not have it
+        """
+        try:
+            with open(self.path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        location = self._locations.get(digest)
+        if location is None:
+            return None
+        name, offset, length = location
+        try:
+            with open(os.path.join(self.files_dir, name), 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except FileNotFoundError:
+            data = b''
+        if sha256(data).digest() != digest:
+            # The file changed since its manifest was saved
+            with self._lock:
+                if self._locations.get(digest) == location:
+                    del self._locations[digest]
+            return None
+        return data
+
+    def put(self, digest, data):
+        """
+        Store a chunk if its content really hashes to `digest`
+
+        Returns:
+            bool: True if the chunk is in the store afterwards
+        """
+        if sha256(data).digest() != digest:
+            return False
+        path = self.path(digest)
+        if os.path.exists(path):
+            # Refresh the timestamp so pruning treats the chunk as recently used
+            os.utime(path)
+            return True
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return True
+
+    def _manifest_path(self, name):
+        return os.path.join(self.manifest_dir, sha256(name.encode('utf-8')).hexdigest())
+
+    def _read_manifest(self, path):
+        """
+        Returns:
+            tuple: (file name, list of (length, digest)), or (None, []) if
+            the manifest is missing
+        """
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None, []
+        (name_length,) = MANIFEST_NAME.unpack_from(data)
+        start = MANIFEST_NAME.size + name_length
+        name = data[MANIFEST_NAME.size:start].decode('utf-8')
+        return name, list(MANIFEST_ENTRY.iter_unpack(memoryview(data)[start:]))
+
+    def _index(self, name, chunks):
+        offset = 0
+        for length, digest in chunks:
+            self._locations[digest] = (name, offset, length)
+            offset += length
+
+    def save_manifest(self, name, chunks):
+        """
+        Record the chunks a file just stored in `files_dir` is made of,
+        replacing any earlier revision, and delete the separate copies of
+        those chunks now that the file holds them
+
+        Args:
+            name: File name in `files_dir`
+            chunks: List of (length, digest) in file order
+        """
+        encoded = name.encode('utf-8')
+        with self._lock:
+            path = self._manifest_path(name)
+            _, previous = self._read_manifest(path)
+            for _, digest in previous:
+                if self._locations.get(digest, (None,))[0] == name:
+                    del self._locations[digest]
+
+            temp_path = path + ".tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(MANIFEST_NAME.pack(len(encoded)) + encoded)
+                f.write(b''.join(MANIFEST_ENTRY.pack(length, digest) for length, digest in chunks))
+            os.replace(temp_path, path)
+            self._index(name, chunks)
+
+        for _, digest in chunks:
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+
+    def prune(self, max_age):
+        """
+        Delete chunk copies that no manifest refers to and that have not
+        been written for `max_age` seconds. The grace period keeps the
+        chunks of interrupted uploads around so they can still be resumed.
+
+        Returns:
+            int: Number of chunks removed
+        """
+        with self._lock:
+            referenced = {digest.hex() for digest in self._locations}
+
+        cutoff = time.time() - max_age
+        removed = 0
+        for prefix in os.listdir(self.root_dir):
+            directory = os.path.join(self.root_dir, prefix)
+            if prefix == "manifests" or not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if name not in referenced and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+        return removed
@@ -0,0 +1,224 @@
+'''
+Asynchronous Event Log for the Secure File Transfer Server
+Connection handlers queue log rows in memory; a background thread writes
+them in batches to a CSV or JSONL file that is rotated by size and age
+'''
+
+import os
+import csv
+import json
+import time
+import datetime
+import queue
+import atexit
+import threading
+
+# Columns of a log row, in order. Rows may stop early.
+LOG_FIELDS = ["Date", "Timestamp", "Client Address", "Event", "Filename", "Status", "Details"]
+LOG_FORMATS = ('csv', 'jsonl')
+
+# Rows written per batch at most, and how long the writer waits for more
+# rows before writing a partial batch
+BATCH_SIZE = 256
+FLUSH_INTERVAL = 0.5
+# Rotate the log once it reaches this size or age, keeping this many old
+# files as <path>.1 (newest) to <path>.<LOG_BACKUPS>
+MAX_LOG_BYTES = 10 * 1024 * 1024
+ROTATE_INTERVAL = 24 * 60 * 60
+LOG_BACKUPS = 5
+
+# Queued by close() to stop the writer
+_STOP = object()
+
+
+class EventLog:
+    """
+    Append-only event log written by a single background thread.
+
+    `log` only puts the row on a queue, so request threads never touch the
+    file. The writer takes rows off the queue in batches and writes each
+    batch with one write and flush, so rows from concurrent connections are
+    never interleaved and are on disk within about FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, path, log_format='csv', max_bytes=MAX_LOG_BYTES,
+                 rotate_interval=ROTATE_INTERVAL, backups=LOG_BACKUPS):
+        """
+        Args:
+            path: Log file to append to
+            log_format: 'csv' (rows with a header line) or 'jsonl' (one
+                object per line, keyed by LOG_FIELDS)
+            max_bytes: Size at which the log is rotated (0 disables)
+            rotate_interval: Seconds after which the log is rotated (0 disables)
+            backups: Rotated files kept
+        """
+        if log_format not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format {log_format!r}, expected one of {', '.join(LOG_FORMATS)}")
+        self.path = path
+        self.log_format = log_format
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backups = backups
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._opened_at = None
+        self._header_size = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self._thread.start()
+        # Rows still queued when the interpreter exits are written, not lost
+        atexit.register(self.close)
+
+    def log(self, row):
+        """
+        Queue a row (a list of values in LOG_FIELDS order). Returns at once.
+        """
+        self._queue.put(row)
+
+    def flush(self, timeout=None):
+        """
+        Block until every row queued before this call has been written
+
+        Returns:
+            bool: False if `timeout` seconds passed first
+        """
+        if self._closed:
+            return True
+        written = threading.Event()
+        self._queue.put(written)
+        return written.wait(timeout)
+
+    def close(self):
+        """
+        Write the remaining rows and stop the writer
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            # Wait for the first row of a batch, then take whatever else is queued
+            items = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(items) < BATCH_SIZE and items[-1] is not _STOP:
+                try:
+                    items.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            rows = [item for item in items if isinstance(item, list)]
+            if rows:
+                try:
+                    self._write(rows)
+                except Exception as e:
+                    print(f"Warning: could not write {len(rows)} log rows to {self.path}: {e}")
+
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if items[-1] is _STOP:
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _write(self, rows):
+        if self._file is None:
+            self._open()
+        # Checked after opening too, so a log left over from a day ago is
+        # rotated before the first batch rather than after it
+        if self._should_rotate():
+            self._open()
+
+        lines = []
+        if self.log_format == 'csv':
+            writer = csv.writer(_LineBuffer(lines))
+            writer.writerows([[str(value) for value in row] for row in rows])
+        else:
+            for row in rows:
+                lines.append(json.dumps(dict(zip(LOG_FIELDS, map(str, row)))) + "\n")
+        self._file.write(''.join(lines))
+        self._file.flush()
+
+    def _should_rotate(self):
+        if self.rotate_interval and time.time() - self._opened_at >= self.rotate_interval:
+            return self._file.tell() > self._header_size
+        return bool(self.max_bytes) and self._file.tell() >= self.max_bytes
+
+    def _open(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._rotate()
+        elif os.path.exists(self.path) and not self._matches_fields():
+            # A log left by an older server with other columns: move it aside
+            # rather than append rows that do not match its header
+            self._rotate()
+
+        self._file = open(self.path, 'a', newline='', encoding='utf-8')
+        header, first_row = self._first_lines()
+        self._header_size = len(header.encode('utf-8')) if self.log_format == 'csv' else 0
+        if self.log_format == 'csv' and self._file.tell() == 0:
+            csv.writer(self._file).writerow(LOG_FIELDS)
+            self._header_size = self._file.tell()
+        self._opened_at = self._row_time(first_row) or time.time()
+
+    def _rotate(self):
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def _first_lines(self):
+        """
+        Returns:
+            tuple: (header line, first row line) of the log, '' where missing.
+            A JSONL log has no header line.
+        """
+        try:
+            with open(self.path, newline='', encoding='utf-8', errors='replace') as f:
+                lines = [f.readline(), f.readline()]
+        except FileNotFoundError:
+            return '', ''
+        if self.log_format == 'jsonl':
+            return '', lines[0]
+        return lines[0], lines[1]
+
+    def _matches_fields(self):
+        # Whether the existing log was written with LOG_FIELDS
+        header, first_row = self._first_lines()
+        if self.log_format == 'csv':
+            return not header or next(csv.reader([header]), None) == LOG_FIELDS
+        try:
+            return not first_row.strip() or set(json.loads(first_row)) <= set(LOG_FIELDS)
+        except (ValueError, TypeError):
+            return False
+
+    def _row_time(self, line):
+        """
+        Time of a row of the log from its Date and Timestamp columns, so the
+        log's age counts from its first row rather than from when this
+        process opened it
+
+        Returns:
+            float: Seconds since the epoch, or None if the row has no time
+        """
+        try:
+            if self.log_format == 'csv':
+                row = dict(zip(LOG_FIELDS, next(csv.reader([line]))))
+            else:
+                row = json.loads(line)
+            return datetime.datetime.fromisoformat(f"{row['Date']}T{row['Timestamp']}").timestamp()
+        except (StopIteration, ValueError, TypeError, KeyError):
+            return None
+
+
+class _LineBuffer:
+    # Lets csv.writer format rows into a list of strings instead of a file
+    def __init__(self, lines):
+        self.write = lines.append
@@ -0,0 +1,84 @@
+'''
+Merkle Tree Cache for the Secure File Transfer Server
+Keeps the Merkle tree of every stored file on disk, so files that have not
+changed since they were hashed are served without hashing them again
+'''
+
+import os
+import struct
+import tempfile
+from hashlib import sha256
+
+from merkle import LEAF_SIZE, MerkleTree
+
+# Sidecar header: file size, file mtime in nanoseconds, leaf size, leaf count
+CACHE_HEADER = struct.Struct('!QqII')
+
+
+class MerkleCache:
+    """
+    One sidecar per stored file in `<root>/<sha256 of the filename>`,
+    holding every level of its tree. An entry is only used while the
+    file's size and modification time still match the ones it was saved
+    with, so any rewrite of the file invalidates it.
+    """
+
+    def __init__(self, root_dir, leaf_size=LEAF_SIZE):
+        self.root_dir = root_dir
+        self.leaf_size = leaf_size
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, file_path):
+        name = os.path.basename(file_path)
+        return os.path.join(self.root_dir, sha256(name.encode('utf-8')).hexdigest())
+
+    def get(self, file_path):
+        """
+        Return the cached tree of a file, or None if there is no entry or
+        the file changed since it was saved
+        """
+        try:
+            stat = os.stat(file_path)
+            with open(self._path(file_path), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < CACHE_HEADER.size:
+            return None
+
+        size, mtime_ns, leaf_size, leaf_count = CACHE_HEADER.unpack_from(data)
+        if (size, mtime_ns, leaf_size) != (stat.st_size, stat.st_mtime_ns, self.leaf_size):
+            return None
+        try:
+            return MerkleTree.from_nodes(leaf_count, memoryview(data)[CACHE_HEADER.size:])
+        except ValueError:
+            return None
+
+    def put(self, file_path, tree, stat=None):
+        """
+        Save the tree of a file
+
+        Args:
+            file_path: The stored file
+            tree: Its MerkleTree
+            stat: os.stat() of the file taken before it was hashed; taken
+                now if None. A file changed while hashing then misses.
+        """
+        stat = stat or os.stat(file_path)
+        fd, temp_path = tempfile.mkstemp(dir=self.root_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(CACHE_HEADER.pack(stat.st_size, stat.st_mtime_ns, self.leaf_size, tree.leaf_count))
+            f.write(tree.nodes())
+        os.replace(temp_path, self._path(file_path))
+
+    def load(self, file_path, build):
+        """
+        Return the cached tree of a file, calling `build()` and caching its
+        result on a miss
+        """
+        tree = self.get(file_path)
+        if tree is None:
+            stat = os.stat(file_path)
+            tree = build()
+            self.put(file_path, tree, stat)
+        return tree
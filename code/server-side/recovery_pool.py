@@ -0,0 +1,255 @@
+'''
+BERT Recovery Worker Pool for the Secure File Transfer Server
+Runs BERT recovery jobs in worker processes that each load the model once,
+so a connection never waits on a recovery and recoveries never block transfers
+'''
+
+import queue
+import secrets
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Job states reported to clients by the Status command
+QUEUED = "Queued"
+RUNNING = "Running"
+RECOVERED = "Recovered"
+FAILED = "Failed"
+
+# Finished jobs remembered for status queries, oldest dropped first
+MAX_FINISHED_JOBS = 1000
+
+# In a worker process: the model and inference backend to load, the
+# BERTRecoveryIntegration once it has been loaded (None if loading failed),
+# and the queue the IDs of jobs are put on as they start
+_model_name = None
+_backend = None
+_recovery = None
+_loaded = False
+_started = None
+
+
+def _init_worker(model_name, backend, started):
+    global _model_name, _backend, _started
+    _model_name = model_name
+    _backend = backend
+    _started = started
+
+
+def _run_job(job_id, job, args):
+    """
+    Run a job in a worker process, first telling the server it has started.
+    A job can sit in the executor's call queue before any worker takes it,
+    so the future alone cannot tell a queued job from a running one.
+    """
+    _started.put(job_id)
+    return job(*args)
+
+
+def _load_model():
+    """
+    Load the model on the worker's first job, so torch and the weights are
+    only brought in once something actually needs recovering
+    """
+    global _recovery, _loaded
+    if not _loaded:
+        _loaded = True
+        try:
+            from bert_integration import BERTRecoveryIntegration
+            _recovery = BERTRecoveryIntegration(_model_name, _backend)
+        except Exception as e:
+            print(f"Warning: BERT initialization failed in recovery worker: {e}")
+            _recovery = None
+    return _recovery
+
+
+def warm_up_job():
+    """
+    Worker job: load the model ahead of the first recovery
+
+    Returns:
+        bool: Whether the model is available
+    """
+    return _load_model() is not None
+
+
+def recover_leaves_job(file_path, damaged_leaves, leaf_size):
+    """
+    Worker job: recover the damaged Merkle leaves of a plain text file
+
+    Returns:
+        tuple: (model available, {leaf index: recovered leaf bytes})
+    """
+    recovery = _load_model()
+    if recovery is None:
+        return False, None
+    return True, recovery.recover_leaves(file_path, damaged_leaves, leaf_size)
+
+
+def recover_file_job(file_path):
+    """
+    Worker job: recover a whole file
+
+    Returns:
+        tuple: (model available, recovered text or None)
+    """
+    recovery = _load_model()
+    if recovery is None:
+        return False, None
+    return True, recovery.recover_file(file_path)
+
+
+class RecoveryPool:
+    """
+    Queue of recovery jobs served by a pool of model-hosting processes.
+
+    Jobs are identified by a random job ID. When a job's worker returns,
+    its result is handed to the job's `on_result` callback in the server
+    process, which applies it and decides whether the file was recovered.
+    """
+
+    def __init__(self, workers=1, model_name='bert-base-uncased', backend='torch'):
+        """
+        Args:
+            workers: Number of worker processes; each holds its own copy of the model
+            model_name: Model the workers load
+            backend: Inference backend the workers run it on ('torch', 'quantized' or 'onnx')
+        """
+        self.workers = workers
+        self.model_name = model_name
+        self.backend = backend
+        self._executor = None
+        self._started = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Worker processes are only started once the first job arrives.
+        # Callers hold self._lock.
+        if self._executor is None:
+            self._started = multiprocessing.Queue()
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                 initargs=(self.model_name, self.backend, self._started))
+        return self._executor
+
+    def warm_up(self):
+        """
+        Start the workers and have each load the model in the background,
+        so the first recovery does not wait for it. Returns immediately.
+        """
+        with self._lock:
+            executor = self._get_executor()
+            futures = [executor.submit(warm_up_job) for _ in range(self.workers)]
+        futures[0].add_done_callback(
+            lambda future: print("BERT recovery workers ready" if not future.exception() and future.result()
+                                 else "Warning: BERT recovery workers could not load the model"))
+
+    def submit(self, filename, job, args, on_result):
+        """
+        Queue a recovery job
+
+        Args:
+            filename: File being recovered, reported in status queries
+            job: Module-level job function run in a worker process
+            args: Arguments for the job
+            on_result: Callable taking the job's return values and returning
+                (recovered, details); runs in the server process
+
+        Returns:
+            str: The job ID
+        """
+        job_id = secrets.token_hex(8)
+        record = {'filename': filename, 'state': None, 'started': False, 'details': '',
+                  'done': threading.Event()}
+        broken = None
+        with self._lock:
+            self._jobs[job_id] = record
+            try:
+                record['future'] = self._get_executor().submit(_run_job, job_id, job, args)
+            except BrokenProcessPool:
+                # A worker died, for example out of memory loading the model:
+                # start a fresh pool rather than fail every later recovery
+                broken = self._discard_executor()
+                record['future'] = self._get_executor().submit(_run_job, job_id, job, args)
+        if broken is not None:
+            broken.shutdown(wait=False)
+        record['future'].add_done_callback(lambda future: self._finish(job_id, future, on_result))
+        return job_id
+
+    def _finish(self, job_id, future, on_result):
+        try:
+            recovered, details = on_result(*future.result())
+        except Exception as e:
+            recovered, details = False, f"Recovery failed: {e}"
+
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None or record['state'] is not None:
+                # Already failed when its pool was discarded
+                return
+            record.update(state=RECOVERED if recovered else FAILED, details=details, future=None)
+            finished = [key for key, job in self._jobs.items() if job['state'] is not None]
+            for key in finished[:-MAX_FINISHED_JOBS]:
+                del self._jobs[key]
+        record['done'].set()
+
+    def _discard_executor(self):
+        """
+        Drop a broken executor, failing the jobs that were queued or running
+        on it. Callers hold self._lock.
+
+        Returns:
+            ProcessPoolExecutor: The broken executor, to be shut down
+        """
+        broken, self._executor, self._started = self._executor, None, None
+        for record in self._jobs.values():
+            if record['state'] is None and record.get('future') is not None:
+                record.update(state=FAILED, details="Recovery worker stopped unexpectedly", future=None)
+                record['done'].set()
+        return broken
+
+    def status(self, job_id):
+        """
+        Current state of a job
+
+        Returns:
+            tuple: (state, details), or None for an unknown job ID
+        """
+        with self._lock:
+            record = self._jobs.get(job_id)
+            if record is None:
+                return None
+            if record['state'] is not None:
+                return record['state'], record['details']
+            self._collect_started()
+            state = RUNNING if record['started'] else QUEUED
+            return state, f"Recovering {record['filename']}"
+
+    def _collect_started(self):
+        # Mark the jobs workers have reported starting. Callers hold self._lock.
+        while self._started is not None:
+            try:
+                job_id = self._started.get_nowait()
+            except queue.Empty:
+                return
+            if job_id in self._jobs:
+                self._jobs[job_id]['started'] = True
+
+    def wait(self, job_id):
+        """
+        Block until a job has finished and return its (state, details)
+        """
+        with self._lock:
+            record = self._jobs[job_id]
+        record['done'].wait()
+        return record['state'], record['details']
+
+    def shutdown(self, wait=True):
+        """
+        Stop the workers, finishing queued jobs first if `wait` is True
+        """
+        with self._lock:
+            executor = self._executor
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -6,26 +6,54 @@ Enhanced with BERT-based text file recovery
 '''
 
 import os
-import csv
 import socket
+import signal
 import datetime
 import base64
 from hashlib import sha256
 from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
 import sys
 
 # Add the parent directory to path to import BERT integration
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# Initialize BERT recovery system
-print("Initializing BERT-based file recovery system...")
-try:
-    from bert_integration import BERTRecoveryIntegration
-    bert_recovery = BERTRecoveryIntegration()
-    print("BERT recovery system initialized successfully")
-except Exception as e:
-    print(f"Warning: BERT initialization failed: {e}")
-    bert_recovery = None
+from transfer_protocol import (LEGACY_VERSION, PROTOCOL_VERSION, VERSION_SEPARATOR, ProtocolError,
+                               parse_transfer_type, negotiate_version,
+                               recv_frames, unpack_block, send_text, recv_text, send_offer, send_bitmap,
+                               recv_bitmap, recv_manifest)
+from merkle import LEAF_SIZE, PARALLEL_THRESHOLD, MerkleTree, shutdown_hash_pool
+from merkle_sync import find_mismatched_leaves, request_leaves, finish_repair
+from transfer_state import exclusive_transfer, count_blocks, missing_blocks, map_file, send_blocks
+from chunk_store import ChunkStore
+from merkle_cache import MerkleCache
+from channel_cipher import ChannelCipher
+from server_engine import create_engine
+from recovery_pool import RecoveryPool, RECOVERED, recover_leaves_job, recover_file_job
+from file_processor import FileProcessor, shutdown_extract_pool
+from event_log import EventLog
+
+# BERT recovery runs in worker processes that load the model on their
+# first job, so the server starts without importing torch. Only the file
+# format checks are needed in the server process.
+file_processor = FileProcessor()
+# Set to False to turn BERT recovery off; failed uploads are then rejected
+RECOVERY_ENABLED = True
+# Number of recovery worker processes, each holds its own copy of the model
+RECOVERY_WORKERS = 1
+# Load the model in the background at startup instead of on the first recovery
+RECOVERY_WARMUP = False
+# Inference backend: 'torch' (fp32), 'quantized' (int8, CPU) or 'onnx'
+# (ONNX Runtime, needs onnxruntime). A backend whose predictions drift from
+# fp32 on a sample check falls back to fp32.
+RECOVERY_BACKEND = 'torch'
+recovery_pool = RecoveryPool(RECOVERY_WORKERS, backend=RECOVERY_BACKEND) if RECOVERY_ENABLED else None
+
+# Events are queued and written in batches by a background thread, to a log
+# rotated by size and age. 'csv' is what the client dashboard reads; 'jsonl'
+# writes one JSON object per event instead.
+LOG_FORMAT = 'csv'
+event_log = EventLog("logs." + LOG_FORMAT, LOG_FORMAT)
 
 # Setting the IP address the server, needs to be set
 IP = socket.gethostbyname(socket.gethostname())
@@ -38,8 +66,34 @@ ADDR = (IP,PORT)
 # over the network is 102400 bytes (100 KB)
 SIZE = 102400 
 KEY = 'epVKiOHn7J0sZcJ4-buWQ5ednv3csHdQHfvEKk0qVvk='
-
-# Function to encrypt data using Fernet symmetric encryption
+# Framed transfers send raw AES-GCM encrypted bytes under a key derived from KEY
+cipher = ChannelCipher(KEY)
+
+# Size of the blocks files are downloaded in, and where uploads are
+# assembled before being moved into place
+BLOCK_SIZE = 64 * 1024
+PARTIAL_DIR = os.path.join("Recieved data", ".partial")
+
+# Content-addressed store of upload chunks, used to skip chunks the server
+# already has. Chunks of stored files are read from the files themselves;
+# only chunks of uploads in progress are kept as separate copies, and those
+# no stored file refers to are pruned at startup once they are older than
+# CHUNK_TTL seconds (kept that long so interrupted uploads can still resume).
+chunk_store = ChunkStore(os.path.join("Recieved data", ".chunks"), "Recieved data")
+CHUNK_TTL = 7 * 24 * 60 * 60
+
+# Merkle trees of stored files, reused by downloads until the file changes
+merkle_cache = MerkleCache(os.path.join("Recieved data", ".merkle"))
+
+# Connection handling: 'thread' serves clients from a thread pool,
+# 'asyncio' accepts on an event loop and runs handlers in an executor
+ENGINE_MODE = 'thread'
+# Maximum number of clients served at once, further clients wait to be accepted
+MAX_CONNECTIONS = 64
+# Seconds a client may stay silent before its connection is dropped
+CONNECTION_TIMEOUT = 300
+
+# Function to encrypt data using Fernet symmetric encryption (legacy clients)
 def encrypt_data(data):
     fernet = Fernet(KEY)
     if isinstance(data, str):
@@ -47,7 +101,7 @@ def encrypt_data(data):
     encMessage = fernet.encrypt(data)
     return encMessage
 
-# Function to decrypt data using Fernet symmetric encryption
+# Function to decrypt data using Fernet symmetric encryption (legacy clients)
 def decrypt_data(data):
     fernet = Fernet(KEY)
     if isinstance(data, str):
@@ -86,7 +140,8 @@ def chunk_file(file_path, chunk_size):
     return chunks
 
 # Function to create a Merkle tree from file chunks and 
-# returns the root hash value of the tree
+# returns the root hash value of the tree. Only used for legacy clients,
+# framed transfers are hashed with merkle.MerkleTree.
 def merkle_tree(chunks):
     if len(chunks) == 1:
         return sha256(chunks[0].encode()).hexdigest()
@@ -94,15 +149,9 @@ def merkle_tree(chunks):
     mid = len(chunks) // 2
     left_hash = merkle_tree(chunks[:mid])
     right_hash = merkle_tree(chunks[mid:])
-    print(f"Left Chunk:{chunks[:mid]}, Left Hash: {left_hash}\nRight Chunk:{chunks[mid:]}, Right Hash: {right_hash}\n")
 
     return sha256(left_hash.encode() + right_hash.encode()).hexdigest()
 
-def log_to_csv(log_data):
-    with open("logs.csv", mode='a', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(log_data)
-
 # Enhanced logging function for BERT operations
 def log_bert_operation(operation, filename, details, status):
     """
@@ -118,9 +167,9 @@ def log_bert_operation(operation, filename, details, status):
         status,
         details
     ]
-    log_to_csv(log_data)
+    event_log.log(log_data)
 
-# Function to send large data in chunks
+# Function to send large data in chunks (legacy clients only)
 def send_large_data(conn, data):
     # Send the length of data first
     data_length = len(data)
@@ -137,7 +186,7 @@ def send_large_data(conn, data):
         # Wait for acknowledgment
         conn.recv(1024)
 
-# Function to receive large data in chunks
+# Function to receive large data in chunks (legacy clients only)
 def receive_large_data(conn):
     # Receive the length of data first
     data_length = int(conn.recv(1024).decode())
@@ -156,7 +205,277 @@ def receive_large_data(conn):
     
     return received_data
 
-def upload_file(conn, addr):
+# Function to receive an upload straight to disk. The client first sends
+# the file's Merkle root (which identifies the transfer) and its list of
+# content-defined chunks; the server replies with the chunks its store
+# already holds, from earlier revisions or an interrupted attempt, and the
+# client sends only the rest. The file is then assembled from the received
+# and stored chunks, so memory use does not grow with the file size.
+# Chunks that fail decryption are skipped rather than failing the upload;
+# their regions stay zeroed until the Merkle repair fetches them again.
+# Returns the Merkle tree of the received data and the advertised root.
+def receive_file_chunks(conn, file_path):
+    root, total_length, chunks = recv_manifest(conn)
+    offsets = []
+    offset = 0
+    for length, _ in chunks:
+        offsets.append(offset)
+        offset += length
+
+    with exclusive_transfer(root.hex()):
+        present = bytearray((len(chunks) + 7) // 8)
+        for index, (_, digest) in enumerate(chunks):
+            if chunk_store.has(digest):
+                present[index >> 3] |= 0x80 >> (index & 7)
+        missing = missing_blocks(present, len(chunks))
+        if len(missing) < len(chunks):
+            print(f"Deduplicated upload: {len(chunks) - len(missing)}/{len(chunks)} chunks already stored")
+        send_bitmap(conn, present)
+
+        os.makedirs(PARTIAL_DIR, exist_ok=True)
+        part_path = os.path.join(PARTIAL_DIR, root.hex() + ".part")
+        received = set()
+        try:
+            with open(part_path, 'wb') as f:
+                f.truncate(total_length)
+                _, payloads = recv_frames(conn)
+                for payload in payloads:
+                    index, token = unpack_block(payload)
+                    if not 0 <= index < len(chunks):
+                        raise ProtocolError(f"Chunk {index} is not in the manifest")
+                    try:
+                        data = cipher.decrypt(token)
+                    except (InvalidTag, ValueError):
+                        # Damaged in transit: its region stays zeroed and the
+                        # Merkle repair below fetches it again
+                        continue
+                    length, digest = chunks[index]
+                    if len(data) != length:
+                        raise ProtocolError(f"Chunk {index} has {len(data)} bytes, expected {length}")
+                    f.seek(offsets[index])
+                    f.write(data)
+                    # Chunks that do not match their digest are not stored either
+                    chunk_store.put(digest, data)
+                    received.add(index)
+
+                unavailable = 0
+                for index, (length, digest) in enumerate(chunks):
+                    if index in received:
+                        continue
+                    data = chunk_store.get(digest)
+                    if data is None:
+                        # Damaged in transit, or pruned from the store since it
+                        # was offered: left for the Merkle repair as well
+                        unavailable += 1
+                        continue
+                    f.seek(offsets[index])
+                    f.write(data)
+                if unavailable:
+                    print(f"⚠️ {unavailable} chunks arrived damaged or were not available, leaving them for repair")
+
+            tree = MerkleTree.from_file(part_path)
+            os.replace(part_path, file_path)
+            merkle_cache.put(file_path, tree)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    chunk_store.save_manifest(os.path.basename(file_path), chunks)
+    return tree, root.hex()
+
+# Function to send a stored file to the client in encrypted blocks, after
+# offering its Merkle root so an interrupted download can be resumed. The
+# file is memory-mapped once and the blocks sent are slices of the mapping.
+# Its Merkle tree comes from the cache unless the file changed since it was
+# last hashed, in which case it is hashed from the same mapping.
+# Returns the root hash of the file.
+def send_file_blocks(conn, file_path):
+    with map_file(file_path) as view:
+        total_length = len(view)
+        if total_length >= PARALLEL_THRESHOLD:
+            # Large files are hashed by worker processes instead
+            tree = merkle_cache.load(file_path, lambda: MerkleTree.from_file(file_path))
+        else:
+            tree = merkle_cache.load(file_path, lambda: MerkleTree.from_bytes(view))
+        send_offer(conn, tree.root, total_length, BLOCK_SIZE)
+        missing = missing_blocks(recv_bitmap(conn), count_blocks(total_length, BLOCK_SIZE))
+        send_blocks(conn, missing, lambda index: view[index * BLOCK_SIZE:(index + 1) * BLOCK_SIZE],
+                    cipher.encrypt)
+    return tree.root_hex
+
+# Function to repair a streamed upload whose root hash does not match.
+# The mismatching leaves are located by comparing subtree hashes with the
+# client, then only those leaves are retransmitted and patched in place.
+# Returns the number of leaves repaired, or None if the file still differs.
+def repair_upload(conn, file_path, tree, hash_val):
+    try:
+        expected_root = bytes.fromhex(hash_val)
+    except ValueError:
+        return None
+
+    expected = find_mismatched_leaves(conn, tree, expected_root)
+    if not expected:
+        return None
+    print(f"🔧 {len(expected)} of {tree.leaf_count} leaves differ, requesting retransmission...")
+
+    indices = sorted(expected)
+    with open(file_path, 'r+b') as f:
+        for i, payload in enumerate(request_leaves(conn, indices)):
+            try:
+                leaf = cipher.decrypt(payload)
+            except (InvalidTag, ValueError):
+                # Damaged again: the root still differs and BERT gets the leaf
+                continue
+            f.seek(indices[i] * LEAF_SIZE)
+            f.write(leaf)
+            tree.update_leaf(indices[i], sha256(leaf).digest())
+
+    if tree.root != expected_root:
+        return None
+    return len(indices)
+
+# Function to log the outcome of a BERT recovery for an upload
+def log_recovery(addr, filename, recovered, details, bert_status):
+    log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Successful" if recovered else "Unsuccessful", details]
+    event_log.log(log_data)
+    log_bert_operation("Recovery", filename, details, bert_status)
+
+# Function to hand an upload that failed its integrity check to the BERT
+# recovery workers. When the damaged leaves are known only those are
+# recovered, otherwise the whole file is.
+# Returns the recovery job ID, or None if BERT cannot recover the file.
+def start_recovery(addr, filename, version, tree, hash_val, damaged_leaves):
+    file_path = "Recieved data/"+ filename
+    if recovery_pool is None:
+        recovery_details = f"BERT recovery system not available"
+        log_recovery(addr, filename, False, recovery_details, "System Unavailable")
+        print('❌ BERT recovery is disabled - file integrity cannot be restored.')
+        return None
+    if not file_processor.is_supported_format(file_path):
+        recovery_details = f"BERT recovery not applicable - File format not supported"
+        log_recovery(addr, filename, False, recovery_details, "Not Applicable")
+        print(f'⚠️ BERT recovery not applicable - {filename} format not supported.')
+        print(f'   Supported formats: {", ".join(file_processor.get_supported_formats())}')
+        return None
+
+    # Results are only applied if the file is not replaced in the meantime
+    stat = os.stat(file_path)
+    if damaged_leaves and file_processor.is_plain_text(file_path):
+        print(f"📄 Queuing BERT recovery of {len(damaged_leaves)} of {tree.leaf_count} leaves of {filename}...")
+        return recovery_pool.submit(filename, recover_leaves_job, (file_path, damaged_leaves, LEAF_SIZE),
+                                    lambda available, recovered: finish_leaf_recovery(
+                                        addr, filename, stat, tree, hash_val, damaged_leaves, available, recovered))
+
+    file_type = os.path.splitext(filename.lower())[1] or "unknown"
+    print(f"📄 File {filename} is a supported format ({file_type}), queuing BERT recovery...")
+    return recovery_pool.submit(filename, recover_file_job, (file_path,),
+                                lambda available, content: finish_file_recovery(
+                                    addr, filename, stat, version, hash_val, file_type, available, content))
+
+# Function to check that a file being recovered has not been replaced by
+# another upload since its recovery was queued
+def unchanged_since(file_path, stat):
+    try:
+        current = os.stat(file_path)
+    except FileNotFoundError:
+        return False
+    return (current.st_size, current.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns)
+
+# Function to apply the leaves recovered by a worker. Each recovered leaf
+# has already been checked against the digest the client sent for it, and
+# is patched into the file and the tree.
+# Returns (recovered, details) for the recovery job.
+def finish_leaf_recovery(addr, filename, stat, tree, hash_val, damaged_leaves, available, recovered):
+    file_path = "Recieved data/"+ filename
+    if not available:
+        recovery_details = f"BERT recovery system not available"
+        log_recovery(addr, filename, False, recovery_details, "System Unavailable")
+        print('❌ BERT recovery system not available - file integrity cannot be restored.')
+        return False, recovery_details
+    if not unchanged_since(file_path, stat):
+        return False, f"{filename} was replaced while it was being recovered"
+
+    if recovered:
+        with open(file_path, 'r+b') as f:
+            for index, leaf in recovered.items():
+                f.seek(index * LEAF_SIZE)
+                f.write(leaf)
+                tree.update_leaf(index, sha256(leaf).digest())
+        merkle_cache.put(file_path, tree)
+
+    recovery_details = f"BERT recovered {len(recovered)} of {len(damaged_leaves)} damaged leaves"
+    print(f"   Recovered hash: {tree.root_hex}")
+    if tree.root_hex == hash_val:
+        log_recovery(addr, filename, True, recovery_details, "Successful")
+        print(f'✅ BERT recovery successful! {recovery_details}.')
+        return True, recovery_details
+    log_recovery(addr, filename, False, recovery_details, "Failed")
+    print(f'❌ BERT recovery failed - {recovery_details}.')
+    return False, recovery_details
+
+# Function to apply a whole file recovered by a worker, if the recovered
+# text hashes to the root the client sent.
+# Returns (recovered, details) for the recovery job.
+def finish_file_recovery(addr, filename, stat, version, hash_val, file_type, available, recovered_content):
+    file_path = "Recieved data/"+ filename
+    if not available:
+        recovery_details = f"BERT recovery system not available"
+        log_recovery(addr, filename, False, recovery_details, "System Unavailable")
+        print('❌ BERT recovery system not available - file integrity cannot be restored.')
+        return False, recovery_details
+    if not unchanged_since(file_path, stat):
+        return False, f"{filename} was replaced while it was being recovered"
+
+    if recovered_content is None:
+        # BERT recovery returned None
+        recovery_details = f"BERT recovery failed for {file_type} file - Recovery process returned no content"
+        log_recovery(addr, filename, False, recovery_details, "Failed")
+        print(f'❌ BERT recovery failed for {file_type} file - no content recovered.')
+        return False, recovery_details
+
+    print(f"🔄 BERT recovery completed, verifying integrity...")
+    # Recalculate hash with recovered data
+    recovered_hash = content_root(recovered_content, version)
+    print(f"   Recovered hash: {recovered_hash}")
+
+    if recovered_hash == hash_val:
+        # Recovery successful
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write(recovered_content)
+        recovery_details = f"BERT recovery successful for {file_type} file - File restored to original integrity"
+        log_recovery(addr, filename, True, recovery_details, "Successful")
+        print(f'✅ BERT recovery successful! {file_type} file integrity restored.')
+        return True, recovery_details
+
+    # Recovery failed - hash still doesn't match
+    recovery_details = f"BERT recovery failed for {file_type} file - Hash mismatch after recovery (Expected: {hash_val[:16]}..., Got: {recovered_hash[:16]}...)"
+    log_recovery(addr, filename, False, recovery_details, "Failed")
+    print(f'❌ BERT recovery failed for {file_type} file - file may be severely corrupted.')
+    return False, recovery_details
+
+# Function to compute the root hash of recovered text the same way the
+# client hashed the original: character chunks for legacy clients, byte
+# leaves for streamed uploads
+def content_root(content, version):
+    if version >= PROTOCOL_VERSION:
+        return MerkleTree.from_bytes(content.encode('utf-8')).root_hex
+    return merkle_tree([content[i:i+1024] for i in range(0, len(content), 1024)])
+
+# Function to send a status message to the client. Framed connections
+# send it as a text frame so back-to-back messages stay separate.
+def send_status(conn, text, version):
+    if version >= PROTOCOL_VERSION:
+        send_text(conn, text)
+    else:
+        conn.send(text.encode())
+
+# Function to receive a status message from the client, framed the same way
+def recv_status(conn, version):
+    if version >= PROTOCOL_VERSION:
+        return recv_text(conn)
+    return conn.recv(SIZE).decode()
+
+def upload_file(conn, addr, version=LEGACY_VERSION):
     try:
         # Create the received data directory if it doesn't exist
         os.makedirs("Recieved data", exist_ok=True)
@@ -166,39 +485,63 @@ def upload_file(conn, addr):
         print(f"Filename: {filename} received")
         conn.send("filename recieved".encode()) # Acknowledgemt 
 
-        # Receive, decrypt the file data and store it in a file in the "Recieved data" 
-        # folder of the server with the filename
-        encrypted_data_base64 = receive_large_data(conn).decode()
-        encrypted_data = base64.b64decode(encrypted_data_base64)
-        decrypted_data = decrypt_data(encrypted_data)
-        if isinstance(decrypted_data, bytes):
-            try:
-                decrypted_data = decrypted_data.decode('utf-8')
-            except UnicodeDecodeError:
-                # If UTF-8 fails, try other common encodings
+        integrity_details = "No corruption detected"
+        tree = None
+        damaged_leaves = None
+        if version >= PROTOCOL_VERSION:
+            # Receive the chunks the server does not have yet straight to disk.
+            # The root hash of the client's merkle tree comes with the manifest.
+            tree, hash_val = receive_file_chunks(conn, "Recieved data/"+ filename)
+            hash2 = tree.root_hex
+            print(f"Hash value {hash_val}")
+            print(f"Hash value: {hash2}")
+
+            # Retransmit only the damaged leaves before falling back to BERT
+            if hash2 != hash_val:
+                repaired_leaves = repair_upload(conn, "Recieved data/"+ filename, tree, hash_val)
+                if repaired_leaves is not None:
+                    hash2 = tree.root_hex
+                    merkle_cache.put("Recieved data/"+ filename, tree)
+                    integrity_details = f"Repaired {repaired_leaves} of {tree.leaf_count} leaves by retransmission"
+                    print(f"✅ {integrity_details}")
+                else:
+                    # Note the leaves that still differ, so BERT only has to recover those
+                    damaged_leaves = find_mismatched_leaves(conn, tree, bytes.fromhex(hash_val))
+            finish_repair(conn)
+        else:
+            # Receive, decrypt the file data and store it in a file in the "Recieved data" 
+            # folder of the server with the filename
+            encrypted_data_base64 = receive_large_data(conn).decode()
+            encrypted_data = base64.b64decode(encrypted_data_base64)
+            decrypted_data = decrypt_data(encrypted_data)
+            if isinstance(decrypted_data, bytes):
                 try:
-                    decrypted_data = decrypted_data.decode('latin-1')
-                except:
-                    decrypted_data = decrypted_data.decode('cp1252', errors='ignore')
-        
-        with open("Recieved data/"+ filename, 'w', encoding='utf-8') as f:
-            f.write(decrypted_data)
+                    decrypted_data = decrypted_data.decode('utf-8')
+                except UnicodeDecodeError:
+                    # If UTF-8 fails, try other common encodings
+                    try:
+                        decrypted_data = decrypted_data.decode('latin-1')
+                    except:
+                        decrypted_data = decrypted_data.decode('cp1252', errors='ignore')
+            
+            with open("Recieved data/"+ filename, 'w', encoding='utf-8') as f:
+                f.write(decrypted_data)
 
-        # Receive the root hash value of the merkle tree created in the client
-        hash_val = conn.recv(SIZE).decode()
-        print(f"Hash value {hash_val}")
+            # Receive the root hash value of the merkle tree created in the client
+            hash_val = conn.recv(SIZE).decode()
+            print(f"Hash value {hash_val}")
 
-        # Create chunks from the received file and calculate the Merkle tree root hash
-        ch = chunk_file("Recieved data/"+ filename, 1024)
-        hash2 = merkle_tree(ch)
-        print(f"Hash value: {hash2}")
+            # Create chunks from the received file and calculate the Merkle tree root hash
+            ch = chunk_file("Recieved data/"+ filename, 1024)
+            hash2 = merkle_tree(ch)
+            print(f"Hash value: {hash2}")
 
         # Enhanced integrity check with BERT recovery
         if hash2 == hash_val:
             # Integrity check passed - no corruption detected
-            conn.send("True".encode())
-            log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Successful", "No corruption detected"]
-            log_to_csv(log_data)
+            send_status(conn, "True", version)
+            log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Successful", integrity_details]
+            event_log.log(log_data)
             print('✅ File integrity verified - no corruption detected')
         else:
             # Integrity check failed - attempt BERT recovery
@@ -207,128 +550,83 @@ def upload_file(conn, addr):
             print(f"   Received hash: {hash2}")
             print("🔄 Attempting BERT-based file recovery...")
             
-            if bert_recovery is not None:
-                # Check if file is a supported format
-                if bert_recovery.is_text_file("Recieved data/"+ filename):
-                    file_info = bert_recovery.file_processor.get_file_info("Recieved data/"+ filename)
-                    file_type = file_info['extension'] if file_info else "unknown"
-                    print(f"📄 File {filename} is a supported format ({file_type}), attempting BERT recovery...")
-                    
-                    # Process corrupted file with BERT
-                    recovered_content = bert_recovery.recover_file("Recieved data/"+ filename)
-                    
-                    if recovered_content is not None:
-                        print(f"🔄 BERT recovery completed, verifying integrity...")
-                        
-                        # Recalculate hash with recovered data
-                        recovered_chunks = [recovered_content[i:i+1024] for i in range(0, len(recovered_content), 1024)]
-                        recovered_hash = merkle_tree(recovered_chunks)
-                        print(f"   Recovered hash: {recovered_hash}")
-                        
-                        if recovered_hash == hash_val:
-                            # Recovery successful
-                            with open("Recieved data/"+ filename, 'w', encoding='utf-8') as f:
-                                f.write(recovered_content)
-                            
-                            conn.send("True".encode())
-                            recovery_details = f"BERT recovery successful for {file_type} file - File restored to original integrity"
-                            log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Successful", recovery_details]
-                            log_to_csv(log_data)
-                            log_bert_operation("Recovery", filename, recovery_details, "Successful")
-                            print(f'✅ BERT recovery successful! {file_type} file integrity restored.')
-                        else:
-                            # Recovery failed - hash still doesn't match
-                            conn.send("False".encode())
-                            recovery_details = f"BERT recovery failed for {file_type} file - Hash mismatch after recovery (Expected: {hash_val[:16]}..., Got: {recovered_hash[:16]}...)"
-                            log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Unsuccessful", recovery_details]
-                            log_to_csv(log_data)
-                            log_bert_operation("Recovery", filename, recovery_details, "Failed")
-                            print(f'❌ BERT recovery failed for {file_type} file - file may be severely corrupted.')
-                    else:
-                        # BERT recovery returned None
-                        conn.send("False".encode())
-                        recovery_details = f"BERT recovery failed for {file_type} file - Recovery process returned no content"
-                        log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Unsuccessful", recovery_details]
-                        log_to_csv(log_data)
-                        log_bert_operation("Recovery", filename, recovery_details, "Failed")
-                        print(f'❌ BERT recovery failed for {file_type} file - no content recovered.')
-                else:
-                    # File is not a supported format
-                    conn.send("False".encode())
-                    recovery_details = f"BERT recovery not applicable - File format not supported"
-                    log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Unsuccessful", recovery_details]
-                    log_to_csv(log_data)
-                    log_bert_operation("Recovery", filename, recovery_details, "Not Applicable")
-                    print(f'⚠️ BERT recovery not applicable - {filename} format not supported.')
-                    print(f'   Supported formats: {", ".join(bert_recovery.get_supported_formats())}')
+            job_id = start_recovery(addr, filename, version, tree, hash_val, damaged_leaves)
+            if job_id is None:
+                send_status(conn, "False", version)
+            elif version >= PROTOCOL_VERSION:
+                # Acknowledge at once, the client asks for the outcome with the Status command
+                send_status(conn, f"Recovering{VERSION_SEPARATOR}{job_id}", version)
             else:
-                # BERT not available
-                conn.send("False".encode())
-                recovery_details = f"BERT recovery system not available"
-                log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Upload", filename, "Unsuccessful", recovery_details]
-                log_to_csv(log_data)
-                log_bert_operation("Recovery", filename, recovery_details, "System Unavailable")
-                print('❌ BERT recovery system not available - file integrity cannot be restored.')
+                # Legacy clients have no Status command and wait for the outcome
+                state, _ = recovery_pool.wait(job_id)
+                send_status(conn, "True" if state == RECOVERED else "False", version)
 
         # Once file transfer is done, a message to the client is sent regarding it
         print(f"File Data Recieved")
-        conn.send("File data recieved".encode())
+        send_status(conn, "File data recieved", version)
     except Exception as e:
         print(f"Error in upload_file: {e}")
         try:
-            conn.send("False".encode())
-            conn.send("Upload failed".encode())
+            send_status(conn, "False", version)
+            send_status(conn, "Upload failed", version)
         except:
             pass
 
-def download_file(conn, addr):
+def download_file(conn, addr, version=LEGACY_VERSION):
     # Create the received data directory if it doesn't exist
     os.makedirs("Recieved data", exist_ok=True)
     
     # Receive the filename
     filename = conn.recv(SIZE).decode()
     print(f"Filename: {filename} received")
-    conn.send("filename recieved".encode()) # Acknowledgemt 
+    # Framed on v9 so the statuses below cannot run together in one recv
+    send_status(conn, "filename recieved", version) # Acknowledgemt 
 
     # Checks if the file the client needs exists in the server
     if os.path.exists("Recieved data/" + filename):
         # A message is sent to the client saying the file exists
-        conn.send("Exist".encode())
+        send_status(conn, "Exist", version)
         print("File exists")
 
-        msg =  conn.recv(SIZE).decode()
+        msg = recv_status(conn, version)
         print(msg)
 
-        # Read, Encrypt and send the file data to the client
-        try:
-            with open("Recieved data/"+ filename, 'r', encoding='utf-8') as f:
-                data = f.read()
-        except UnicodeDecodeError:
-            # If UTF-8 fails, try other encodings
+        if version >= PROTOCOL_VERSION:
+            # Send the file in encrypted blocks, skipping any the client already has
+            hash1 = send_file_blocks(conn, "Recieved data/"+ filename)
+            print(f"Hash value: {hash1}")
+        else:
+            # Read, Encrypt and send the file data to the client
             try:
-                with open("Recieved data/"+ filename, 'r', encoding='latin-1') as f:
-                    data = f.read()
-            except:
-                with open("Recieved data/"+ filename, 'r', encoding='cp1252', errors='ignore') as f:
+                with open("Recieved data/"+ filename, 'r', encoding='utf-8') as f:
                     data = f.read()
+            except UnicodeDecodeError:
+                # If UTF-8 fails, try other encodings
+                try:
+                    with open("Recieved data/"+ filename, 'r', encoding='latin-1') as f:
+                        data = f.read()
+                except:
+                    with open("Recieved data/"+ filename, 'r', encoding='cp1252', errors='ignore') as f:
+                        data = f.read()
         
-        encrypted_data = encrypt_data(data)
-        encrypted_data_base64 = base64.b64encode(encrypted_data).decode('utf-8')
-        send_large_data(conn, encrypted_data_base64.encode())
-
-        # Create chunks from the file and calculate the Merkle tree root hash
-        ch = chunk_file("Recieved data/"+filename, 1024)
-        hash1 = merkle_tree(ch)
-        print(f"Hash value: {hash1}")
-        conn.send(hash1.encode())
+            encrypted_data = encrypt_data(data)
+            encrypted_data_base64 = base64.b64encode(encrypted_data).decode('utf-8')
+            send_large_data(conn, encrypted_data_base64.encode())
+
+            # Create chunks from the file and calculate the Merkle tree root hash
+            ch = chunk_file("Recieved data/"+filename, 1024)
+            hash1 = merkle_tree(ch)
+            print(f"Hash value: {hash1}")
+            conn.send(hash1.encode())
+
         log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Download", filename, "Successful" ]
-        log_to_csv(log_data)
+        event_log.log(log_data)
 
     else:
         # A message is sent to the client if the file does not exist
-        conn.send("NotExist".encode())
+        send_status(conn, "NotExist", version)
         log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Download", filename, "File not found" ]
-        log_to_csv(log_data)
+        event_log.log(log_data)
         print("File does not exists")
 
 def show_files(conn, addr):
@@ -349,50 +647,79 @@ def show_files(conn, addr):
 
     conn.send(files.encode())
     log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Get File Names" ]
-    log_to_csv(log_data)
+    event_log.log(log_data)
     print("File names sent!")
 
-def main():
-    print("Server is starting...")
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind(ADDR)
-    server.listen()
-    print("Server is listening")
-    
-    while True:
-        conn,  addr = server.accept()
-        print(F"New connection {addr} connected.")
-        log_data = [str(datetime.datetime.now().date()), str(datetime.datetime.now().time()), str(addr), "New connection"]
-        log_to_csv(log_data)
+# Function to report the state of a BERT recovery job to the client
+def recovery_status(conn, addr, version=LEGACY_VERSION):
+    job_id = conn.recv(SIZE).decode()
+    status = recovery_pool.status(job_id) if recovery_pool is not None else None
+    state, details = status if status is not None else ("Unknown", "No such recovery job")
+    send_status(conn, state, version)
+    send_status(conn, details, version)
+    log_data = [str(datetime.datetime.now().date()),str(datetime.datetime.now().time()), str(addr), "Recovery Status", job_id, state]
+    event_log.log(log_data)
+
+# Serves a single client connection. Runs on an engine worker thread, so
+# several clients can be uploading or downloading at the same time.
+def handle_client(conn, addr):
+    log_data = [str(datetime.datetime.now().date()), str(datetime.datetime.now().time()), str(addr), "New connection"]
+    event_log.log(log_data)
+
+    # Receive the type of transfer (Upload or Download) from the client,
+    # optionally followed by the protocol version the client speaks
+    transfertype, offered = parse_transfer_type(conn.recv(SIZE).decode())
+    version = negotiate_version(offered)
+    print(f"Received transfertype: {transfertype} (protocol v{version})")
+    ack = "Recieved Transfer type"
+    if version != LEGACY_VERSION:
+        ack += f"{VERSION_SEPARATOR}{version}"
+    conn.send(ack.encode()) # Acknowledgemt 
+
+    # If the client wants to upload files to the server:
+    if transfertype=="Upload":
+        upload_file(conn, addr, version)
+
+    # If the client wants to download files from the client:
+    elif transfertype=="Download":
+        download_file(conn, addr, version)
+
+    elif transfertype=="Show":
+        show_files(conn, addr)
+
+    # If the client wants to know how a BERT recovery is going:
+    elif transfertype=="Status":
+        recovery_status(conn, addr, version)
 
-        # Receive the type of transfer (Upload or Download) from the client
-        transfertype = conn.recv(SIZE).decode()
-        print(f"Received transfertype: {transfertype}")
-        conn.send("Recieved Transfer type".encode()) # Acknowledgemt 
-
-        # If the client wants to upload files to the server:
-        if transfertype=="Upload":
-            upload_file(conn, addr)
-
-        # If the client wants to download files from the client:
-        elif transfertype=="Download":
-            download_file(conn, addr)
-
-        elif transfertype=="Show":
-            show_files(conn, addr)
-
-        else:
-            # Error in the revieved transfer type info
-            print("Invalid Transfer Type Recieved")
-            break
+    else:
+        # Error in the revieved transfer type info
+        print(f"Invalid Transfer Type Recieved from {addr}")
 
-    conn.close()
-    print(f"Disconnected {addr} ")
-    return
+def main():
+    print("Server is starting...")
+    removed = chunk_store.prune(CHUNK_TTL)
+    if removed:
+        print(f"Pruned {removed} unreferenced chunks from the chunk store")
+    engine = create_engine(ENGINE_MODE, handle_client,
+                           max_connections=MAX_CONNECTIONS,
+                           connection_timeout=CONNECTION_TIMEOUT)
+
+    # Stop accepting on SIGTERM and let in-flight transfers finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.shutdown())
+
+    if recovery_pool is not None and RECOVERY_WARMUP:
+        print("Loading the BERT model in the background...")
+        recovery_pool.warm_up()
+
+    print(f"Server is listening ({ENGINE_MODE} engine, up to {MAX_CONNECTIONS} clients)")
+    engine.serve_forever(ADDR)
+    # Let queued recoveries finish before exiting
+    if recovery_pool is not None:
+        recovery_pool.shutdown()
+    shutdown_hash_pool()
+    shutdown_extract_pool()
+    event_log.close()
+    print("Server stopped")
 
 if __name__ == '__main__':
-    if not os.path.exists("logs.csv"):
-        with open("logs.csv", mode='w', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow(["Date","Timestamp", "Client Address", "Event", "Filename", "Status" ])
     main()
\ No newline at end of file
@@ -0,0 +1,185 @@
+'''
+Connection Engines for the Secure File Transfer Server
+Thread-pool and asyncio accept loops with bounded concurrency,
+per-connection timeouts and graceful shutdown
+'''
+
+import asyncio
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# How often blocked accept loops wake up to check for shutdown (seconds)
+POLL_INTERVAL = 1.0
+
+
+class ServerEngine:
+    """
+    Base class for server engines. An engine owns the listening socket and
+    hands every accepted connection to `handler(conn, addr)`, which is free
+    to block; the engine closes the connection once the handler returns.
+    """
+
+    def __init__(self, handler, max_connections=64, connection_timeout=300.0):
+        """
+        Args:
+            handler: Callable taking (conn, addr) that serves one client
+            max_connections: Maximum number of clients served at once
+            connection_timeout: Socket timeout in seconds for each client, None to disable
+        """
+        self.handler = handler
+        self.max_connections = max_connections
+        self.connection_timeout = connection_timeout
+        self._stopping = threading.Event()
+        self._active = 0
+        self._active_lock = threading.Lock()
+
+    @property
+    def active_connections(self):
+        return self._active
+
+    def serve_forever(self, addr):
+        """
+        Bind to `addr` and serve clients until shutdown() is called or the
+        process is interrupted, then wait for in-flight clients to finish
+        """
+        raise NotImplementedError
+
+    def shutdown(self):
+        """
+        Stop accepting new connections. Clients already being served are
+        allowed to finish before serve_forever() returns.
+        """
+        self._stopping.set()
+
+    def _listen(self, addr):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(addr)
+        server.listen(self.max_connections)
+        return server
+
+    def _serve_connection(self, conn, addr):
+        with self._active_lock:
+            self._active += 1
+        try:
+            conn.settimeout(self.connection_timeout)
+            self.handler(conn, addr)
+        except socket.timeout:
+            print(f"Connection {addr} timed out")
+        except Exception as e:
+            print(f"Error serving {addr}: {e}")
+        finally:
+            try:
+                conn.close()
+            except OSError:
+                pass
+            with self._active_lock:
+                self._active -= 1
+            print(f"Disconnected {addr} ")
+
+
+class ThreadPoolEngine(ServerEngine):
+    """
+    Accepts on the calling thread and serves each client on a worker thread.
+    Once `max_connections` clients are active the engine stops accepting and
+    further clients wait in the listen backlog.
+    """
+
+    def serve_forever(self, addr):
+        server = self._listen(addr)
+        server.settimeout(POLL_INTERVAL)
+        slots = threading.BoundedSemaphore(self.max_connections)
+        executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                      thread_name_prefix="client")
+
+        def serve(conn, client_addr):
+            try:
+                self._serve_connection(conn, client_addr)
+            finally:
+                slots.release()
+
+        try:
+            while not self._stopping.is_set():
+                if not slots.acquire(timeout=POLL_INTERVAL):
+                    continue
+                try:
+                    conn, client_addr = server.accept()
+                except socket.timeout:
+                    slots.release()
+                    continue
+                print(f"New connection {client_addr} connected.")
+                executor.submit(serve, conn, client_addr)
+        except KeyboardInterrupt:
+            print("Shutdown requested")
+        finally:
+            self._stopping.set()
+            server.close()
+            print(f"Waiting for {self.active_connections} active connection(s) to finish...")
+            executor.shutdown(wait=True)
+
+
+class AsyncioEngine(ServerEngine):
+    """
+    Accepts on an asyncio event loop and runs the blocking handlers in a
+    bounded executor, so accepting never waits behind a slow client.
+    """
+
+    def serve_forever(self, addr):
+        try:
+            asyncio.run(self._serve(addr))
+        except KeyboardInterrupt:
+            print("Shutdown requested")
+
+    async def _serve(self, addr):
+        loop = asyncio.get_running_loop()
+        server = self._listen(addr)
+        server.setblocking(False)
+        slots = asyncio.Semaphore(self.max_connections)
+        executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                      thread_name_prefix="client")
+        pending = set()
+
+        async def serve(conn, client_addr):
+            try:
+                await loop.run_in_executor(executor, self._serve_connection, conn, client_addr)
+            finally:
+                slots.release()
+
+        try:
+            while not self._stopping.is_set():
+                await slots.acquire()
+                try:
+                    conn, client_addr = await asyncio.wait_for(loop.sock_accept(server), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    slots.release()
+                    continue
+                conn.setblocking(True)
+                print(f"New connection {client_addr} connected.")
+                task = asyncio.create_task(serve(conn, client_addr))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        finally:
+            self._stopping.set()
+            server.close()
+            if pending:
+                print(f"Waiting for {len(pending)} active connection(s) to finish...")
+                await asyncio.gather(*pending, return_exceptions=True)
+            executor.shutdown(wait=True)
+
+
+ENGINES = {
+    'thread': ThreadPoolEngine,
+    'asyncio': AsyncioEngine,
+}
+
+
+def create_engine(mode, handler, **kwargs):
+    """
+    Create a server engine by name ('thread' or 'asyncio')
+    """
+    try:
+        engine_class = ENGINES[mode]
+    except KeyError:
+        raise ValueError(f"Unknown server engine '{mode}', expected one of: {', '.join(ENGINES)}")
+    return engine_class(handler, **kwargs)
@@ -0,0 +1,67 @@
+'''
+Tests for the server's chunk store
+'''
+
+import os
+from hashlib import sha256
+
+from chunk_store import ChunkStore
+
+
+def make_chunks(*pieces):
+    return [(len(piece), sha256(piece).digest()) for piece in pieces]
+
+
+def store_file(tmp_path, name, pieces):
+    (tmp_path / name).write_bytes(b''.join(pieces))
+    return make_chunks(*pieces)
+
+
+def test_chunks_of_stored_files_are_read_from_the_file(tmp_path):
+    store = ChunkStore(str(tmp_path / ".chunks"), str(tmp_path))
+    pieces = [b'a' * 100, b'b' * 200, b'c' * 50]
+    for (_, digest), piece in zip(make_chunks(*pieces), pieces):
+        assert store.put(digest, piece)
+    assert not store.put(sha256(b'x').digest(), b'y')
+
+    chunks = store_file(tmp_path, "f.bin", pieces)
+    store.save_manifest("f.bin", chunks)
+    # The separate copies are gone, the file serves the chunks
+    assert not any(os.path.exists(store.path(digest)) for _, digest in chunks)
+    for (_, digest), piece in zip(chunks, pieces):
+        assert store.has(digest) and store.get(digest) == piece
+
+    # The index is rebuilt from the manifests
+    reopened = ChunkStore(str(tmp_path / ".chunks"), str(tmp_path))
+    assert [reopened.get(digest) for _, digest in chunks] == pieces
+
+
+def test_changed_file_reports_chunks_missing(tmp_path):
+    store = ChunkStore(str(tmp_path / ".chunks"), str(tmp_path))
+    pieces = [b'a' * 100, b'b' * 200]
+    chunks = store_file(tmp_path, "f.bin", pieces)
+    store.save_manifest("f.bin", chunks)
+
+    with open(tmp_path / "f.bin", 'r+b') as f:
+        f.seek(150)
+        f.write(b'X')
+    assert store.get(chunks[0][1]) == pieces[0]
+    assert store.get(chunks[1][1]) is None
+    assert not store.has(chunks[1][1])
+
+
+def test_new_revision_replaces_manifest(tmp_path):
+    store = ChunkStore(str(tmp_path / ".chunks"), str(tmp_path))
+    store.save_manifest("f.bin", store_file(tmp_path, "f.bin", [b'old' * 50, b'same' * 50]))
+    chunks = store_file(tmp_path, "f.bin", [b'same' * 50, b'new' * 50])
+    store.save_manifest("f.bin", chunks)
+    assert not store.has(sha256(b'old' * 50).digest())
+    assert [store.get(digest) for _, digest in chunks] == [b'same' * 50, b'new' * 50]
+
+
+def test_prune_keeps_recent_unreferenced_chunks(tmp_path):
+    store = ChunkStore(str(tmp_path / ".chunks"), str(tmp_path))
+    digest = sha256(b'partial').digest()
+    store.put(digest, b'partial')
+    assert store.prune(60) == 0 and store.has(digest)
+    assert store.prune(-1) == 1 and not store.has(digest)
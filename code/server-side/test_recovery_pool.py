@@ -0,0 +1,42 @@
+'''
+Tests for the BERT recovery worker pool, with plain jobs standing in for BERT
+'''
+
+import os
+import time
+
+from recovery_pool import RecoveryPool, QUEUED, RUNNING, RECOVERED, FAILED
+
+
+def wait_for(pool, job_id, state, timeout=10):
+    deadline = time.monotonic() + timeout
+    while pool.status(job_id)[0] != state and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return pool.status(job_id)[0]
+
+
+def test_jobs_queued_behind_a_busy_worker_are_reported_queued():
+    pool = RecoveryPool(workers=1)
+    try:
+        busy = pool.submit("a.txt", time.sleep, (1.0,), lambda *result: (True, "done"))
+        queued = pool.submit("b.txt", divmod, (7, 2), lambda *result: (result == (3, 1), "checked"))
+        assert wait_for(pool, busy, RUNNING) == RUNNING
+        assert pool.status(queued) == (QUEUED, "Recovering b.txt")
+
+        assert pool.wait(queued) == (RECOVERED, "checked")
+        assert pool.status("unknown") is None
+    finally:
+        pool.shutdown()
+
+
+def test_pool_recovers_from_a_dead_worker():
+    pool = RecoveryPool(workers=1)
+    try:
+        # os._exit kills the worker, which breaks the executor
+        crashed = pool.submit("a.txt", os._exit, (1,), lambda *result: (True, "done"))
+        assert pool.wait(crashed)[0] == FAILED
+
+        job = pool.submit("b.txt", divmod, (7, 2), lambda *result: (result == (3, 1), "checked"))
+        assert pool.wait(job) == (RECOVERED, "checked")
+    finally:
+        pool.shutdown()
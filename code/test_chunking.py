@@ -0,0 +1,59 @@
+'''
+Tests for content-defined chunking
+'''
+
+import os
+import random
+from hashlib import sha256
+
+import pytest
+
+import chunking
+from chunking import ContentChunker, chunk_bytes, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE
+
+
+def chunk_pieces(data, piece_sizes):
+    chunker = ContentChunker()
+    chunks = []
+    offset = 0
+    for size in piece_sizes:
+        chunks += chunker.update(data[offset:offset + size])
+        offset += size
+    chunks += chunker.update(data[offset:])
+    return chunks + chunker.finish()
+
+
+@pytest.mark.parametrize("size", [0, 1, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE + 1, 300 * 1024])
+def test_numpy_matches_pure_python(monkeypatch, size):
+    pytest.importorskip("numpy")
+    data = os.urandom(size) + bytes(size // 4)
+    with_numpy = chunk_bytes(data)
+    monkeypatch.setattr(chunking, "np", None)
+    assert chunk_bytes(data) == with_numpy
+
+
+def test_chunks_cover_the_data():
+    data = os.urandom(500 * 1024) + bytes(200 * 1024)
+    chunks = chunk_bytes(data)
+    assert sum(length for length, _ in chunks) == len(data)
+    offset = 0
+    for index, (length, digest) in enumerate(chunks):
+        assert length <= MAX_CHUNK_SIZE
+        assert length >= MIN_CHUNK_SIZE or index == len(chunks) - 1
+        assert sha256(data[offset:offset + length]).digest() == digest
+        offset += length
+
+
+def test_boundaries_do_not_depend_on_how_data_arrives():
+    data = os.urandom(400 * 1024)
+    rng = random.Random(7)
+    pieces = [rng.randint(1, 20000) for _ in range(30)]
+    assert chunk_pieces(data, pieces) == chunk_bytes(data)
+
+
+def test_insertion_only_changes_nearby_chunks():
+    data = os.urandom(1024 * 1024)
+    edited = data[:500000] + b"inserted bytes" + data[500000:]
+    before = {digest for _, digest in chunk_bytes(data)}
+    after = chunk_bytes(edited)
+    assert sum(digest not in before for _, digest in after) <= 3
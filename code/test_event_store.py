@@ -0,0 +1,90 @@
+'''
+Tests for the dashboard's event store
+'''
+
+import os
+import csv
+import shutil
+
+from event_store import EventStore, BERT_EVENT
+
+SHIPPED_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server-side", "logs.csv")
+
+
+def count_rows(log_path, column, value):
+    with open(log_path, newline='') as f:
+        return sum(1 for row in csv.reader(f) if len(row) > column and row[column] == value)
+
+
+def test_ingests_shipped_log(tmp_path):
+    log = tmp_path / "logs.csv"
+    shutil.copy(SHIPPED_LOG, log)
+
+    with EventStore(str(tmp_path / "events.db")) as store:
+        added = store.ingest(str(log))
+        with open(log, newline='') as f:
+            assert added == sum(1 for row in csv.reader(f) if row) - 1
+
+        # The sample rows keep the log's own header: Date,Timestamp,Event,...
+        counts = store.status_counts(BERT_EVENT)
+        assert sum(counts.values()) == count_rows(log, 2, BERT_EVENT)
+        assert set(counts) <= {'Successful', 'Failed'}
+
+        # Rows the server appended under that header use its own layout
+        assert store.recent('New connection')[-1]['address'].startswith("(")
+
+
+def test_server_rows_under_old_header(tmp_path):
+    log = tmp_path / "logs.csv"
+    shutil.copy(SHIPPED_LOG, log)
+
+    with EventStore(str(tmp_path / "events.db")) as store:
+        store.ingest(str(log))
+        before = store.status_counts(BERT_EVENT)
+
+        with open(log, 'a', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['2026-10-18', '10:00:00.1', BERT_EVENT, 'Recovery', 'f.txt', 'Successful',
+                             'BERT recovered 1 of 1 damaged leaves'])
+            writer.writerow(['2026-10-18', '10:00:00.2', "('127.0.0.1', 5)", 'Upload', 'f.txt', 'Successful',
+                             'Data integrity verified'])
+        assert store.ingest(str(log)) == 2
+
+        after = store.status_counts(BERT_EVENT)
+        assert after['Successful'] == before.get('Successful', 0) + 1
+        assert set(after) <= {'Successful', 'Failed'}
+
+        recovery = store.recent(BERT_EVENT, 1)[0]
+        assert (recovery['operation'], recovery['filename'], recovery['status']) == ('Recovery', 'f.txt', 'Successful')
+        upload = store.recent('Upload', 1)[0]
+        assert (upload['filename'], upload['status']) == ('f.txt', 'Successful')
+
+
+def test_incremental_and_rotated(tmp_path):
+    log = tmp_path / "logs.csv"
+    row = ['2026-10-18', '10:00:00', "('127.0.0.1', 5)", 'Upload', 'a.txt', 'Successful', 'x']
+
+    def append(path, rows, header=False):
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if header:
+                writer.writerow(["Date", "Timestamp", "Client Address", "Event", "Filename", "Status", "Details"])
+            writer.writerows([row] * rows)
+
+    with EventStore(str(tmp_path / "events.db")) as store:
+        append(log, 3, header=True)
+        assert store.ingest(str(log)) == 3
+        assert store.ingest(str(log)) == 0
+
+        # A partly written line waits for the next call
+        append(log, 2)
+        with open(log, 'a') as f:
+            f.write("2026-10-18,10:00")
+        assert store.ingest(str(log)) == 2
+
+        with open(log, 'a') as f:
+            f.write(":00,\"('127.0.0.1', 5)\",Upload,a.txt,Successful,x\n")
+        os.replace(log, str(log) + ".1")
+        append(log, 4, header=True)
+        assert store.ingest(str(log)) == 5
+        assert store.status_counts('Upload') == {'Successful': 10}
@@ -0,0 +1,103 @@
+'''
+Tests for the Merkle tree and the leaf repair exchange
+'''
+
+import os
+import socket
+import threading
+from hashlib import sha256
+
+import pytest
+
+import merkle
+from merkle import LEAF_SIZE, MerkleTree
+from merkle_sync import find_mismatched_leaves, request_leaves, finish_repair, serve_repair_requests
+
+SIZES = [0, 1, LEAF_SIZE - 1, LEAF_SIZE, LEAF_SIZE + 1, 5 * LEAF_SIZE + 17, 64 * LEAF_SIZE]
+
+
+def reference_root(data, leaf_size=LEAF_SIZE):
+    # Pairs hashed level by level, an unpaired node promoted unchanged
+    level = [sha256(data[i:i + leaf_size]).digest() for i in range(0, len(data), leaf_size)]
+    if not level:
+        return sha256(b'').digest()
+    while len(level) > 1:
+        level = [sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+    return level[0]
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_root_matches_reference(size):
+    data = os.urandom(size)
+    assert MerkleTree.from_bytes(data).root == reference_root(data)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_file_and_bytes_agree(tmp_path, size):
+    data = os.urandom(size)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+    tree = MerkleTree.from_file(str(path), workers=1)
+    assert bytes(tree.nodes()) == bytes(MerkleTree.from_bytes(data).nodes())
+
+
+@pytest.mark.parametrize("leaves", [1, 7, 8, 9, 63, 64, 65, 200])
+def test_parallel_matches_serial(tmp_path, monkeypatch, leaves):
+    # Small regions so even small files are split across several workers
+    monkeypatch.setattr(merkle, "PARALLEL_THRESHOLD", 0)
+    monkeypatch.setattr(merkle, "MIN_REGION_LEAVES", 4)
+    data = os.urandom(leaves * LEAF_SIZE - 3)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+    try:
+        parallel = MerkleTree.from_file(str(path), workers=3)
+    finally:
+        merkle.shutdown_hash_pool()
+    assert bytes(parallel.nodes()) == bytes(MerkleTree.from_file(str(path), workers=1).nodes())
+
+
+def test_from_nodes_round_trip():
+    tree = MerkleTree.from_bytes(os.urandom(37 * LEAF_SIZE))
+    copy = MerkleTree.from_nodes(tree.leaf_count, bytes(tree.nodes()))
+    assert copy.root == tree.root
+    with pytest.raises(ValueError):
+        MerkleTree.from_nodes(tree.leaf_count + 1, bytes(tree.nodes()))
+
+
+def test_update_leaf():
+    data = bytearray(os.urandom(37 * LEAF_SIZE + 5))
+    tree = MerkleTree.from_bytes(data)
+    for index in (0, 17, 36, 37):
+        data[index * LEAF_SIZE] ^= 0xff
+        tree.update_leaf(index, sha256(data[index * LEAF_SIZE:(index + 1) * LEAF_SIZE]).digest())
+        assert tree.root == reference_root(bytes(data))
+
+
+def test_leaf_repair():
+    original = os.urandom(300 * LEAF_SIZE + 99)
+    damaged = bytearray(original)
+    for index in (0, 5, 150, 300):
+        damaged[index * LEAF_SIZE] ^= 0xff
+    sent = MerkleTree.from_bytes(original)
+    received = MerkleTree.from_bytes(damaged)
+
+    ours, theirs = socket.socketpair()
+    server = threading.Thread(target=serve_repair_requests, args=(
+        theirs, sent, lambda i: original[i * LEAF_SIZE:(i + 1) * LEAF_SIZE], lambda leaf: leaf))
+    server.start()
+    try:
+        mismatched = find_mismatched_leaves(ours, received, sent.root)
+        assert sorted(mismatched) == [0, 5, 150, 300]
+        indices = sorted(mismatched)
+        for index, leaf in zip(indices, list(request_leaves(ours, indices))):
+            assert sha256(leaf).digest() == mismatched[index]
+            damaged[index * LEAF_SIZE:index * LEAF_SIZE + len(leaf)] = leaf
+            received.update_leaf(index, sha256(leaf).digest())
+        assert received.root == sent.root and bytes(damaged) == original
+        assert find_mismatched_leaves(ours, received, sent.root) == {}
+        finish_repair(ours)
+    finally:
+        server.join(5)
+        ours.close()
+        theirs.close()
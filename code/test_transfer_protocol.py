@@ -0,0 +1,84 @@
+'''
+Tests for the framed wire protocol
+'''
+
+import os
+import socket
+import threading
+
+import pytest
+
+import transfer_protocol as tp
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def in_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.start()
+    return thread
+
+
+def test_version_negotiation():
+    assert tp.parse_transfer_type(tp.offer_transfer_type("Upload")) == ("Upload", tp.PROTOCOL_VERSION)
+    assert tp.parse_transfer_type("Upload") == ("Upload", tp.LEGACY_VERSION)
+    assert tp.parse_transfer_type("Upload:x") == ("Upload", tp.LEGACY_VERSION)
+    assert tp.negotiate_version(tp.PROTOCOL_VERSION + 1) == tp.PROTOCOL_VERSION
+    assert tp.negotiate_version(tp.PROTOCOL_VERSION - 1) == tp.LEGACY_VERSION
+
+
+@pytest.mark.parametrize("size, frame_size, window", [(0, 1024, 4), (1, 1024, 1), (100000, 1000, 3),
+                                                      (300000, tp.DEFAULT_FRAME_SIZE, tp.DEFAULT_WINDOW)])
+def test_stream_round_trip(pair, size, frame_size, window):
+    data = os.urandom(size)
+    sender = in_thread(tp.send_stream, pair[0], data, frame_size, window)
+    assert tp.recv_stream(pair[1]) == data
+    sender.join(5)
+
+
+def test_frames_stay_separate(pair):
+    tp.send_text(pair[0], "first")
+    tp.send_text(pair[0], "second")
+    assert tp.recv_text(pair[1]) == "first"
+    assert tp.recv_text(pair[1]) == "second"
+
+
+def test_manifest_round_trip(pair):
+    chunks = [(10, b'\1' * 32), (20, b'\2' * 32)]
+    tp.send_manifest(pair[0], b'\0' * 32, 30, chunks)
+    assert tp.recv_manifest(pair[1]) == (b'\0' * 32, 30, chunks)
+
+    tp.send_manifest(pair[0], b'\0' * 32, 31, chunks)
+    with pytest.raises(tp.ProtocolError):
+        tp.recv_manifest(pair[1])
+
+
+def test_unexpected_frame_type(pair):
+    tp.send_text(pair[0], "not an offer")
+    with pytest.raises(tp.ProtocolError):
+        tp.recv_offer(pair[1])
+
+
+def test_oversized_frame_is_refused(pair):
+    pair[0].sendall(tp.HEADER.pack(tp.PROTOCOL_VERSION, tp.MSG_DATA, 1, tp.MAX_FRAME_SIZE + 1))
+    with pytest.raises(tp.ProtocolError):
+        tp.recv_frame(pair[1])
+
+
+def test_wrong_version_is_refused(pair):
+    pair[0].sendall(tp.HEADER.pack(tp.PROTOCOL_VERSION + 1, tp.MSG_TEXT, 0, 0))
+    with pytest.raises(tp.ProtocolError):
+        tp.recv_frame(pair[1])
+
+
+def test_connection_closed_mid_frame(pair):
+    pair[0].sendall(tp.HEADER.pack(tp.PROTOCOL_VERSION, tp.MSG_TEXT, 0, 10) + b'short')
+    pair[0].close()
+    with pytest.raises(ConnectionError):
+        tp.recv_frame(pair[1])
@@ -0,0 +1,86 @@
+'''
+Tests for resumable transfers
+'''
+
+import os
+import socket
+import threading
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+import transfer_state
+from transfer_state import (TransferState, send_blocks, receive_blocks, missing_blocks, count_blocks,
+                            exclusive_transfer)
+
+BLOCK = 1024
+
+
+def transfer(state, data, indices, decrypt=bytes):
+    # Send the given blocks over a socket pair into the transfer's partial file
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=send_blocks, args=(
+        a, indices, lambda i: data[i * BLOCK:(i + 1) * BLOCK], lambda block: block))
+    sender.start()
+    try:
+        receive_blocks(b, state, decrypt)
+    finally:
+        sender.join(5)
+        a.close()
+        b.close()
+
+
+def test_missing_blocks():
+    assert missing_blocks(bytearray([0b10100000]), 4) == [1, 3]
+    assert count_blocks(0, BLOCK) == 0 and count_blocks(BLOCK + 1, BLOCK) == 2
+
+
+def test_resume_after_interruption(tmp_path):
+    data = os.urandom(50 * BLOCK + 10)
+    state = TransferState(str(tmp_path), "root", len(data), BLOCK)
+    transfer(state, data, list(range(0, 51, 3)))
+
+    # A new attempt finds the blocks already written and asks for the rest
+    resumed = TransferState(str(tmp_path), "root", len(data), BLOCK)
+    assert resumed.resumed_blocks == 17
+    assert resumed.missing() == [i for i in range(51) if i % 3]
+    transfer(resumed, data, resumed.missing())
+    assert resumed.complete
+
+    resumed.commit(str(tmp_path / "done"))
+    assert (tmp_path / "done").read_bytes() == data
+    assert os.listdir(tmp_path) == ["done"]
+
+
+def test_state_for_another_file_is_ignored(tmp_path):
+    data = os.urandom(10 * BLOCK)
+    transfer(TransferState(str(tmp_path), "root", len(data), BLOCK), data, [0, 1])
+    assert TransferState(str(tmp_path), "root", len(data) + 1, BLOCK).resumed_blocks == 0
+    assert TransferState(str(tmp_path), "root", len(data), BLOCK * 2).resumed_blocks == 0
+
+
+def test_tampered_block_is_fetched_again(tmp_path):
+    data = os.urandom(10 * BLOCK)
+    tampered = data[4 * BLOCK:5 * BLOCK]
+
+    def decrypt(token):
+        if token == tampered:
+            raise InvalidTag()
+        return token
+
+    state = TransferState(str(tmp_path), "root", len(data), BLOCK)
+    transfer(state, data, state.missing(), decrypt)
+    assert TransferState(str(tmp_path), "root", len(data), BLOCK).missing() == [4]
+
+    transfer(state, data, state.missing())
+    assert state.complete
+
+
+def test_transfer_in_use_is_refused_after_timeout(monkeypatch):
+    monkeypatch.setattr(transfer_state, "TRANSFER_WAIT_TIMEOUT", 0.1)
+    with exclusive_transfer("root"):
+        with pytest.raises(TimeoutError):
+            with exclusive_transfer("root"):
+                pass
+    with exclusive_transfer("root"):
+        pass
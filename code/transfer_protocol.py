@@ -0,0 +1,360 @@
+'''
+Framed Wire Protocol for the Secure File Transfer System
+Length-prefixed binary frames with a sliding in-flight window,
+negotiated per connection so legacy clients keep working
+'''
+
+import struct
+
+# Version 1 is the original "send 8 KB, wait for OK" exchange.
+# Version 2 streams fixed-header binary frames with periodic checkpoints.
+# Version 3 streams uploads as individually encrypted chunks.
+# Version 4 hashes framed transfers with the bottom-up MerkleTree.
+# Version 5 repairs damaged uploads by retransmitting mismatching leaves.
+# Version 6 offers the Merkle root up front and resumes partial transfers.
+# Version 7 uploads content-defined chunks the server does not already have.
+# Version 8 encrypts blocks with AES-GCM into raw bytes instead of Fernet tokens.
+# Version 9 answers uploads needing BERT recovery with a job ID at once and
+# adds the Status command to ask for the outcome.
+LEGACY_VERSION = 1
+PROTOCOL_VERSION = 9
+
+# Separator used to append the offered version to the transfer type,
+# e.g. "Upload:9". Legacy clients send the bare transfer type.
+VERSION_SEPARATOR = ':'
+
+# Frame types
+MSG_START = 1       # payload: total length + sender window
+MSG_DATA = 2        # payload: a slice of the data
+MSG_END = 3         # empty payload, marks the end of the stream
+MSG_CHECKPOINT = 4  # empty payload, seq acknowledges every frame up to it
+MSG_TEXT = 9        # payload: a UTF-8 status message (5-8 are the merkle_sync repair frames)
+MSG_OFFER = 10      # payload: Merkle root, total length and block size of a file
+MSG_BITMAP = 11     # payload: one bit per block the receiver already holds
+MSG_MANIFEST = 12   # payload: Merkle root, total length, then (length, digest) per chunk
+
+# Fixed-size frame header: version, message type, sequence number, payload length
+HEADER = struct.Struct('!BBIQ')
+START_PAYLOAD = struct.Struct('!QI')
+OFFER_PAYLOAD = struct.Struct('!32sQI')
+MANIFEST_HEADER = struct.Struct('!32sQ')
+MANIFEST_ENTRY = struct.Struct('!I32s')
+# Block frames carry the index of the block they hold ahead of the data
+BLOCK_INDEX = struct.Struct('!I')
+
+DEFAULT_FRAME_SIZE = 64 * 1024  # 64 KB per data frame
+DEFAULT_WINDOW = 32             # frames allowed in flight before waiting
+
+# Largest payload accepted from the peer, checked before anything is
+# allocated for it. Data frames are far smaller; the largest others are
+# repair requests of 4 bytes per damaged leaf.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Manifests grow with the file, 36 bytes per chunk of about 8 KB, so they
+# get a cap of their own: enough for files of about 50 GB
+MAX_MANIFEST_SIZE = 256 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the peer sends a malformed or unexpected frame
+    """
+
+
+def offer_transfer_type(transfertype, version=PROTOCOL_VERSION):
+    """
+    Build the transfer type message a client sends to open a connection
+    """
+    return f"{transfertype}{VERSION_SEPARATOR}{version}"
+
+
+def parse_transfer_type(message):
+    """
+    Split a transfer type message into the transfer type and offered version
+
+    Returns:
+        tuple: (transfertype, version) - version is LEGACY_VERSION when none is offered
+    """
+    transfertype, sep, version = message.partition(VERSION_SEPARATOR)
+    if not sep:
+        return message, LEGACY_VERSION
+    try:
+        return transfertype, int(version)
+    except ValueError:
+        return transfertype, LEGACY_VERSION
+
+
+def negotiate_version(offered):
+    """
+    Pick the version both sides speak. Framed versions are only used when
+    the peer supports the current one, otherwise fall back to legacy.
+    """
+    return PROTOCOL_VERSION if offered >= PROTOCOL_VERSION else LEGACY_VERSION
+
+
+def recv_exact(sock, length):
+    """
+    Receive exactly `length` bytes from the socket
+
+    Raises:
+        ConnectionError: if the peer closes the connection early
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        n = sock.recv_into(view[received:], length - received)
+        if n == 0:
+            raise ConnectionError(f"Connection closed after {received}/{length} bytes")
+        received += n
+    return bytes(buf)
+
+
+def send_frame(sock, msg_type, seq, payload=b''):
+    """
+    Send a single frame (header followed by payload)
+    """
+    header = HEADER.pack(PROTOCOL_VERSION, msg_type, seq, len(payload))
+    if len(payload) <= 4096:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def recv_frame(sock, max_size=MAX_FRAME_SIZE):
+    """
+    Receive a single frame
+
+    Args:
+        sock: Connected socket
+        max_size: Largest payload accepted
+
+    Returns:
+        tuple: (msg_type, seq, payload)
+
+    Raises:
+        ProtocolError: if the frame announces a payload over `max_size`
+    """
+    version, msg_type, seq, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported frame version {version}")
+    if length > max_size:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the {max_size} byte limit")
+    payload = recv_exact(sock, length) if length else b''
+    return msg_type, seq, payload
+
+
+def send_text(sock, text):
+    """
+    Send a short status message as a single frame, so consecutive messages
+    can never run together on the stream
+    """
+    send_frame(sock, MSG_TEXT, 0, text.encode('utf-8'))
+
+
+def recv_text(sock):
+    """
+    Receive a status message sent with send_text
+    """
+    msg_type, _, payload = recv_frame(sock)
+    if msg_type != MSG_TEXT:
+        raise ProtocolError(f"Expected TEXT frame, got type {msg_type}")
+    return payload.decode('utf-8')
+
+
+def send_offer(sock, root, total_length, block_size):
+    """
+    Announce a file before sending it: its raw Merkle root (which doubles as
+    the transfer ID), its length and the size of the blocks it is sent in
+    """
+    send_frame(sock, MSG_OFFER, 0, OFFER_PAYLOAD.pack(root, total_length, block_size))
+
+
+def recv_offer(sock):
+    """
+    Receive a file announcement sent with send_offer
+
+    Returns:
+        tuple: (root, total_length, block_size)
+    """
+    msg_type, _, payload = recv_frame(sock)
+    if msg_type != MSG_OFFER:
+        raise ProtocolError(f"Expected OFFER frame, got type {msg_type}")
+    return OFFER_PAYLOAD.unpack(payload)
+
+
+def send_manifest(sock, root, total_length, chunks):
+    """
+    Announce a file as a list of variable-size chunks, so the receiver can
+    say which of them it already holds
+
+    Args:
+        sock: Connected socket
+        root: Raw Merkle root of the whole file
+        total_length: Size of the file in bytes
+        chunks: List of (length, raw sha256 digest) in file order
+    """
+    entries = b''.join(MANIFEST_ENTRY.pack(length, digest) for length, digest in chunks)
+    send_frame(sock, MSG_MANIFEST, 0, MANIFEST_HEADER.pack(root, total_length) + entries)
+
+
+def recv_manifest(sock):
+    """
+    Receive a chunk manifest sent with send_manifest
+
+    Returns:
+        tuple: (root, total_length, chunks)
+    """
+    msg_type, _, payload = recv_frame(sock, MAX_MANIFEST_SIZE)
+    if msg_type != MSG_MANIFEST:
+        raise ProtocolError(f"Expected MANIFEST frame, got type {msg_type}")
+    if (len(payload) - MANIFEST_HEADER.size) % MANIFEST_ENTRY.size:
+        raise ProtocolError("Malformed MANIFEST frame")
+    root, total_length = MANIFEST_HEADER.unpack_from(payload)
+    chunks = list(MANIFEST_ENTRY.iter_unpack(memoryview(payload)[MANIFEST_HEADER.size:]))
+    if sum(length for length, _ in chunks) != total_length:
+        raise ProtocolError("MANIFEST chunk lengths do not add up to the file size")
+    return root, total_length, chunks
+
+
+def send_bitmap(sock, bitmap):
+    """
+    Tell the sender which blocks are already held, bit i of byte i // 8
+    (most significant bit first) standing for block i
+    """
+    send_frame(sock, MSG_BITMAP, 0, bytes(bitmap))
+
+
+def recv_bitmap(sock):
+    """
+    Receive a block bitmap sent with send_bitmap
+    """
+    msg_type, _, payload = recv_frame(sock)
+    if msg_type != MSG_BITMAP:
+        raise ProtocolError(f"Expected BITMAP frame, got type {msg_type}")
+    return payload
+
+
+def pack_block(index, payload):
+    """
+    Prefix a block's payload with its index
+    """
+    return BLOCK_INDEX.pack(index) + payload
+
+
+def unpack_block(payload):
+    """
+    Split a block frame payload into (index, data)
+    """
+    (index,) = BLOCK_INDEX.unpack_from(payload)
+    return index, memoryview(payload)[BLOCK_INDEX.size:]
+
+
+def checkpoint_interval(window):
+    """
+    Number of data frames the receiver lets through between checkpoints.
+    Checkpointing at half the window keeps the sender from ever stalling
+    on a full window while the acknowledgement is still in transit.
+    """
+    return max(1, window // 2)
+
+
+def send_frames(sock, payloads, total_length, window=DEFAULT_WINDOW):
+    """
+    Stream an iterable of payloads to the peer, one data frame each, without
+    waiting for a round trip per frame. At most `window` frames are
+    unacknowledged, so payloads can be produced lazily as they are sent.
+
+    Args:
+        sock: Connected socket
+        payloads: Iterable of bytes-like objects
+        total_length: Length of the content the stream describes, announced to the receiver
+        window: Maximum number of frames in flight
+    """
+    send_frame(sock, MSG_START, 0, START_PAYLOAD.pack(total_length, window))
+
+    seq = 0
+    acked = 0
+    for payload in payloads:
+        seq += 1
+        send_frame(sock, MSG_DATA, seq, payload)
+        while seq - acked >= window:
+            acked = _recv_checkpoint(sock)
+
+    seq += 1
+    send_frame(sock, MSG_END, seq)
+    while acked < seq:
+        acked = _recv_checkpoint(sock)
+
+
+def recv_frames(sock):
+    """
+    Start receiving a stream sent with send_frames
+
+    Returns:
+        tuple: (total_length, payloads) - payloads is a generator that yields
+        each data frame's payload and must be consumed to the end
+    """
+    msg_type, _, payload = recv_frame(sock)
+    if msg_type != MSG_START:
+        raise ProtocolError(f"Expected START frame, got type {msg_type}")
+    total_length, window = START_PAYLOAD.unpack(payload)
+    return total_length, _iter_frames(sock, checkpoint_interval(window))
+
+
+def send_stream(sock, data, frame_size=DEFAULT_FRAME_SIZE, window=DEFAULT_WINDOW):
+    """
+    Stream an in-memory byte string to the peer as framed messages
+
+    Args:
+        sock: Connected socket
+        data: bytes-like object to send
+        frame_size: Maximum payload size of each data frame
+        window: Maximum number of frames in flight
+    """
+    view = memoryview(data)
+    frames = (view[offset:offset + frame_size] for offset in range(0, len(view), frame_size))
+    send_frames(sock, frames, len(view), window)
+
+
+def recv_stream(sock):
+    """
+    Receive a stream sent with send_stream
+
+    Returns:
+        bytes: The reassembled data
+    """
+    total_length, payloads = recv_frames(sock)
+    received = bytearray()
+    for payload in payloads:
+        received += payload
+
+    if len(received) != total_length:
+        raise ProtocolError(f"Stream length mismatch: got {len(received)}, expected {total_length}")
+    return bytes(received)
+
+
+def _iter_frames(sock, interval):
+    expected_seq = 1
+    while True:
+        msg_type, seq, payload = recv_frame(sock)
+        if seq != expected_seq:
+            raise ProtocolError(f"Out of order frame {seq}, expected {expected_seq}")
+        expected_seq += 1
+
+        if msg_type == MSG_END:
+            send_frame(sock, MSG_CHECKPOINT, seq)
+            return
+        if msg_type != MSG_DATA:
+            raise ProtocolError(f"Unexpected frame type {msg_type} in stream")
+
+        yield payload
+        if seq % interval == 0:
+            send_frame(sock, MSG_CHECKPOINT, seq)
+
+
+def _recv_checkpoint(sock):
+    msg_type, seq, _ = recv_frame(sock)
+    if msg_type != MSG_CHECKPOINT:
+        raise ProtocolError(f"Expected CHECKPOINT frame, got type {msg_type}")
+    return seq
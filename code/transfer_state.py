@@ -0,0 +1,236 @@
+'''
+Resumable Transfer State for the Secure File Transfer System
+A partially received file is kept on disk together with a bitmap of the
+blocks already written, keyed by the Merkle root of the complete file
+'''
+
+import os
+import mmap
+import struct
+import threading
+from contextlib import contextmanager
+
+from cryptography.exceptions import InvalidTag
+
+from transfer_protocol import send_frames, recv_frames, pack_block, unpack_block
+
+# Sidecar header: total length and block size the bitmap was recorded for
+STATE_HEADER = struct.Struct('!QI')
+# Blocks written between bitmap saves
+SAVE_INTERVAL = 16
+# Seconds to wait for another connection to finish the same transfer
+TRANSFER_WAIT_TIMEOUT = 60
+
+
+# Transfer IDs currently being written, so two connections never write
+# the same partial file at once
+_active_transfers = set()
+_active_transfers_changed = threading.Condition()
+
+
+@contextmanager
+def exclusive_transfer(transfer_id):
+    """
+    Hold a transfer ID for the duration of a transfer, waiting for any
+    other connection already using it to finish
+
+    Raises:
+        TimeoutError: If the other connection still holds it after
+            TRANSFER_WAIT_TIMEOUT seconds
+    """
+    with _active_transfers_changed:
+        if not _active_transfers_changed.wait_for(lambda: transfer_id not in _active_transfers,
+                                                  TRANSFER_WAIT_TIMEOUT):
+            raise TimeoutError(f"Transfer {transfer_id} is still in use by another connection")
+        _active_transfers.add(transfer_id)
+    try:
+        yield
+    finally:
+        with _active_transfers_changed:
+            _active_transfers.discard(transfer_id)
+            _active_transfers_changed.notify_all()
+
+
+def count_blocks(total_length, block_size):
+    return (total_length + block_size - 1) // block_size
+
+
+def has_block(bitmap, index):
+    return bool(bitmap[index >> 3] & (0x80 >> (index & 7)))
+
+
+def missing_blocks(bitmap, block_count):
+    """
+    Indices of the blocks whose bit is not set
+    """
+    return [index for index in range(block_count) if not has_block(bitmap, index)]
+
+
+class TransferState:
+    """
+    On-disk state of one resumable transfer. Blocks are written straight
+    into `<root>.part` and recorded in `<root>.bitmap`; the bitmap is only
+    saved after the data it covers has been flushed, so after a crash it
+    can lag behind the data but never claim blocks that are not there.
+    """
+
+    def __init__(self, state_dir, root_hex, total_length, block_size):
+        """
+        Args:
+            state_dir: Directory holding partial transfers
+            root_hex: Merkle root of the complete file, used as the transfer ID
+            total_length: Size of the complete file in bytes
+            block_size: Size of the blocks the file is sent in
+        """
+        os.makedirs(state_dir, exist_ok=True)
+        self.part_path = os.path.join(state_dir, root_hex + ".part")
+        self.bitmap_path = os.path.join(state_dir, root_hex + ".bitmap")
+        self.total_length = total_length
+        self.block_size = block_size
+        self.block_count = count_blocks(total_length, block_size)
+        self.bitmap = bytearray((self.block_count + 7) // 8)
+        self._unsaved = 0
+        self._load()
+
+    def _load(self):
+        if not (os.path.exists(self.part_path) and os.path.exists(self.bitmap_path)):
+            return
+        with open(self.bitmap_path, 'rb') as f:
+            data = f.read()
+        if len(data) != STATE_HEADER.size + len(self.bitmap):
+            return
+        if STATE_HEADER.unpack_from(data) != (self.total_length, self.block_size):
+            return
+        self.bitmap[:] = data[STATE_HEADER.size:]
+
+    @property
+    def resumed_blocks(self):
+        return self.block_count - len(self.missing())
+
+    @property
+    def complete(self):
+        return not self.missing()
+
+    def missing(self):
+        return missing_blocks(self.bitmap, self.block_count)
+
+    def open(self):
+        """
+        Open the partial file for writing blocks, creating it at full size
+        """
+        mode = 'r+b' if os.path.exists(self.part_path) else 'w+b'
+        f = open(self.part_path, mode)
+        f.truncate(self.total_length)
+        return f
+
+    def write_block(self, f, index, data):
+        """
+        Write one block into the partial file opened with open()
+        """
+        if not 0 <= index < self.block_count:
+            raise ValueError(f"Block {index} out of range ({self.block_count} blocks)")
+        expected = min(self.block_size, self.total_length - index * self.block_size)
+        if len(data) != expected:
+            raise ValueError(f"Block {index} has {len(data)} bytes, expected {expected}")
+
+        f.seek(index * self.block_size)
+        f.write(data)
+        self.bitmap[index >> 3] |= 0x80 >> (index & 7)
+        self._unsaved += 1
+        if self._unsaved >= SAVE_INTERVAL:
+            f.flush()
+            self.save()
+
+    def save(self):
+        """
+        Persist the bitmap. Callers must flush the partial file first.
+        """
+        temp_path = self.bitmap_path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(STATE_HEADER.pack(self.total_length, self.block_size))
+            f.write(self.bitmap)
+        os.replace(temp_path, self.bitmap_path)
+        self._unsaved = 0
+
+    def commit(self, dest_path):
+        """
+        Move the completed file into place and drop the state
+        """
+        if not os.path.exists(self.part_path):
+            open(self.part_path, 'wb').close()
+        os.replace(self.part_path, dest_path)
+        if os.path.exists(self.bitmap_path):
+            os.remove(self.bitmap_path)
+
+    def discard(self):
+        """
+        Throw away the partial file and its bitmap
+        """
+        for path in (self.part_path, self.bitmap_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def read_block(f, index, block_size):
+    """
+    Read one block of a file opened in binary mode
+    """
+    f.seek(index * block_size)
+    return f.read(block_size)
+
+
+@contextmanager
+def map_file(file_path):
+    """
+    Map a file read-only and yield a memoryview over it, so blocks can be
+    sliced out without copying. Empty files, which cannot be mapped, yield
+    an empty view.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b'')
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            view = memoryview(mapping)
+            try:
+                yield view
+            finally:
+                view.release()
+
+
+def send_blocks(sock, indices, read, encrypt):
+    """
+    Stream the given blocks to the peer, each encrypted and tagged with
+    its index
+
+    Args:
+        sock: Connected socket
+        indices: Block indices to send, usually the ones the peer is missing
+        read: Callable returning the plaintext of a block by index
+        encrypt: Callable encrypting a block before it is sent
+    """
+    frames = (pack_block(index, encrypt(read(index))) for index in indices)
+    send_frames(sock, frames, len(indices))
+
+
+def receive_blocks(sock, state, decrypt):
+    """
+    Receive blocks sent with send_blocks into a transfer's partial file.
+    The bitmap is saved even if the connection drops part way through, so
+    the next attempt only asks for what is still missing. Blocks that fail
+    decryption are skipped and their bits left clear in the same way.
+    """
+    _, payloads = recv_frames(sock)
+    with state.open() as f:
+        try:
+            for payload in payloads:
+                index, token = unpack_block(payload)
+                try:
+                    block = decrypt(bytes(token))
+                except (InvalidTag, ValueError):
+                    # Damaged in transit, fetched again by the next attempt
+                    continue
+                state.write_block(f, index, block)
+        finally:
+            f.flush()
+            state.save()